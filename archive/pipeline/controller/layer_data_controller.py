@@ -129,20 +129,17 @@ class AnnotationPointController(Controller):
                 if 'annotations' in l:
                     name = l['name']
                     annotation = l['annotations']
-                    d = [row['point'] for row in annotation]
-                    df = pd.DataFrame(d, columns=['X', 'Y', 'Section'])
-                    df['X'] = df['X'].astype(int)
-                    df['Y'] = df['Y'].astype(int)
-                    df['Section'] = df['Section'].astype(int)
-                    df['Layer'] = name
-                    df = df[['Layer', 'X', 'Y', 'Section']]
+                    # one cast of all the points, then the name goes in front
+                    points = np.array([row['point'] for row in annotation], dtype=np.float64).reshape(-1, 3)
+                    df = pd.DataFrame(points.astype(int), columns=['X', 'Y', 'Section'])
+                    df.insert(0, 'Layer', name)
                     dfs.append(df)
             if len(dfs) == 0:
                 result = None
-            elif len(dfs) == 1:
-                result = dfs[0]
             else:
-                result = pd.concat(dfs)
+                result = pd.concat(dfs, ignore_index=True, copy=False)
+                # the name repeats on every row of a layer, store it once per layer
+                result['Layer'] = result['Layer'].astype('category')
 
         return result
     
@@ -19,10 +19,11 @@ class SlideCZIToTifController(Controller):
         return self.session.query(SlideCziTif).get(ID)
 
     def get_slide_czi_to_tifs(self, channel):
-        slides = self.session.query(Slide).filter(Slide.scan_run_id == self.scan_run.id)\
-            .filter(Slide.slide_status == 'Good').all()
-        slide_czi_to_tifs = self.session.query(SlideCziTif).filter(SlideCziTif.channel == channel)\
-            .filter(SlideCziTif.FK_slide_id.in_([slide.id for slide in slides]))\
+        slide_czi_to_tifs = self.session.query(SlideCziTif)\
+            .join(Slide, SlideCziTif.FK_slide_id == Slide.id)\
+            .filter(Slide.scan_run_id == self.scan_run.id)\
+            .filter(Slide.slide_status == 'Good')\
+            .filter(SlideCziTif.channel == channel)\
             .filter(SlideCziTif.active == 1).all()
 
         return slide_czi_to_tifs
@@ -1,4 +1,3 @@
-from sqlalchemy import func
 from sqlalchemy.orm.exc import NoResultFound
 
 from controller.main_controller import Controller
@@ -11,6 +10,20 @@ class StructuresController(Controller):
         """        
         Controller.__init__(self,*args,**kwargs)
 
+    def get_structures_by_abbreviation(self):
+        """The structure table is small and does not change during a run, so it is
+        read once per controller and the lookups by abbreviation are done on a dict.
+        The dict keys are case sensitive like the BINARY search.
+
+        Returns:
+            dict: structure ORM keyed by abbreviation
+        """
+        structures = getattr(self, 'structures_by_abbreviation', None)
+        if structures is None:
+            structures = {structure.abbreviation: structure for structure in self.session.query(Structure).all()}
+            self.structures_by_abbreviation = structures
+        return structures
+
     def get_structure_color(self, abbrv):
         """
         Returns a color code as int
@@ -18,8 +31,7 @@ class StructuresController(Controller):
         :param abbrv: the abbreviation of the structure
         :return: tuple of rgb
         """
-        row = self.session.query(Structure).filter(
-            Structure.abbreviation == func.binary(abbrv)).one()
+        row = self.get_structure(abbrv)
         return int(row.color)
 
     def get_structure_color_rgb(self, abbrv):
@@ -29,8 +41,7 @@ class StructuresController(Controller):
         :param abbrv: the abbreviation of the structure
         :return: tuple of rgb
         """
-        row = self.session.query(Structure).filter(
-            Structure.abbreviation == func.binary(abbrv)).one()
+        row = self.get_structure(abbrv)
         hexa = row.hexadecimal
         h = hexa.lstrip('#')
         return tuple(int(h[i:i + 2], 16) for i in (0, 2, 4))
@@ -66,14 +77,11 @@ class StructuresController(Controller):
         :return: list of structures that exists as pairs on both side of the brain. 
         i.e. structures that is not in the midline
         """
-        rows = self.session.query(Structure).filter(
-            Structure.active.is_(True)).all()
-        structures = []
-        for structure in rows:
-            if "_" in structure.abbreviation:
-                structures.append(structure.abbreviation)
-
-        return sorted(structures)
+        # _ is a LIKE wildcard, so it is escaped to match a literal underscore
+        rows = self.session.query(Structure.abbreviation)\
+            .filter(Structure.active.is_(True))\
+            .filter(Structure.abbreviation.like('%\\_%', escape='\\')).all()
+        return sorted(row.abbreviation for row in rows)
 
     def get_structure(self, abbrv):
         """
@@ -82,7 +90,10 @@ class StructuresController(Controller):
         :param abbrv: the abbreviation of the structure
         :return: structure object
         """
-        return self.session.query(Structure).filter(Structure.abbreviation == func.binary(abbrv)).one()
+        structure = self.get_structures_by_abbreviation().get(abbrv)
+        if structure is None:
+            raise NoResultFound(f'No structure with abbreviation {abbrv}')
+        return structure
     
         
     def structure_abbreviation_to_id(self,abbreviation):
@@ -178,8 +178,6 @@ def file_processed(animal, progress_id, filename, pooledsession):
             .one()
     except NoResultFound:
         return False
-    finally:
-        pooledsession.close()
 
     return True
 
@@ -208,5 +206,3 @@ def set_file_completed(animal, progress_id, filename, pooledsession):
     except Exception as e:
         print(f"No merge for {animal} {filename} {e}")
         pooledsession.rollback()
-    finally:
-        pooledsession.close()
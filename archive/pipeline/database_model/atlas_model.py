@@ -14,5 +14,5 @@ class AtlasModel(object):
     __table_args__ = {'mysql_engine': 'InnoDB'}
     __mapper_args__ = {'always_refresh': True}
 
-    created = Column(DateTime, default=datetime.now())
+    created = Column(DateTime, default=datetime.now)
     active = Column(Boolean, default=True, nullable=False)
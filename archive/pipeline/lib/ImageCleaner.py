@@ -71,14 +71,25 @@ class ImageCleaner:
         self.parallel_create_cleaned(INPUT, CLEANED, MASKS)
 
     def get_section_rotation(self, section: Section):
-        sections = self.sqlController.session.query(SlideCziTif).filter(
-            SlideCziTif.FK_slide_id == section.FK_slide_id
-        )
-        indices = np.sort(np.unique([i.scene_index for i in sections]))
+        indices, slide = self.get_slide_scenes(section.FK_slide_id)
         scene = np.where(indices == section.scene_index)[0][0] + 1
-        slide = self.sqlController.session.query(Slide).get(section.FK_slide_id)
         return getattr(slide, f"scene_rotation_{scene}")
 
+    def get_slide_scenes(self, slide_id):
+        """Sections on the same slide share the scene indices and the slide row,
+        so the two queries are only run once per slide
+        """
+        if not hasattr(self, "_slide_cache"):
+            self._slide_cache = {}
+        if slide_id not in self._slide_cache:
+            sections = self.sqlController.session.query(SlideCziTif).filter(
+                SlideCziTif.FK_slide_id == slide_id
+            )
+            indices = np.sort(np.unique([i.scene_index for i in sections]))
+            slide = self.sqlController.session.query(Slide).get(slide_id)
+            self._slide_cache[slide_id] = (indices, slide)
+        return self._slide_cache[slide_id]
+
     def parallel_create_cleaned(self, INPUT, CLEANED, MASKS):
         max_width = self.sqlController.scan_run.width
         max_height = self.sqlController.scan_run.height
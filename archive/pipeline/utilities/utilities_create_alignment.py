@@ -87,6 +87,26 @@ def parse_elastix(animal):
 
 
 
+def load_allen_rotations(ROT_DIR):
+    """
+    Reads all the CSHL rotation files once, instead of a loadtxt per section.
+    Args:
+        ROT_DIR: directory of the 3x3 rotation text files
+    Returns: a dictionary of key=rotation filename, value = inverse of the rotation
+    """
+    r90 = np.array([[0,-1,0],[1,0,0],[0,0,1]])
+    rotations = {}
+    for rotfile in sorted(os.listdir(ROT_DIR)):
+        if not rotfile.endswith('.txt'):
+            continue
+        R_cshl = np.fromfile(os.path.join(ROT_DIR, rotfile), sep=' ').reshape(3, 3)
+        R_cshl[0,2] = R_cshl[0,2] / SCALING_FACTOR
+        R_cshl[1,2] = R_cshl[1,2] / SCALING_FACTOR
+        R_cshl = R_cshl @ r90
+        rotations[rotfile] = np.linalg.inv(R_cshl)
+    return rotations
+
+
 def run_offsets(animal, transforms, channel, downsample, masks, create_csv, allen):
     """
     This gets the dictionary from the above method, and uses the coordinates
@@ -127,17 +147,12 @@ def run_offsets(animal, transforms, channel, downsample, masks, create_csv, alle
     downsampled_transforms = create_downsampled_transforms(animal, transforms, downsample)
     downsampled_transforms = OrderedDict(sorted(downsampled_transforms.items()))
     file_keys = []
+    if allen:
+        ROT_DIR = os.path.join(fileLocationManager.root, animal, 'rotations')
+        rotations = load_allen_rotations(ROT_DIR)
     for i, (file, T) in enumerate(downsampled_transforms.items()):
         if allen:
-            r90 = np.array([[0,-1,0],[1,0,0],[0,0,1]])
-            ROT_DIR = os.path.join(fileLocationManager.root, animal, 'rotations')
-            rotfile = file.replace('tif', 'txt')
-            rotfile = os.path.join(ROT_DIR, rotfile)
-            R_cshl = np.loadtxt(rotfile)
-            R_cshl[0,2] = R_cshl[0,2] / SCALING_FACTOR
-            R_cshl[1,2] = R_cshl[1,2] / SCALING_FACTOR
-            R_cshl = R_cshl @ r90
-            R_cshl = np.linalg.inv(R_cshl)
+            R_cshl = rotations[file.replace('tif', 'txt')]
             R = T @ R_cshl
         infile = os.path.join(INPUT, file)
         outfile = os.path.join(OUTPUT, file)
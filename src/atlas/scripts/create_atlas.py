@@ -40,18 +40,24 @@ class NumpyToNeuroglancer():
         self.precomputed_vol = None
 
     def init_precomputed(self, path):
+        # compressed_segmentation is what neuroglancer prefers for labels, but it only takes uint32/uint64
+        encoding = 'raw'
+        if self.layer_type == 'segmentation' and self.volume.dtype in (np.uint32, np.uint64):
+            encoding = 'compressed_segmentation'
         info = CloudVolume.create_new_info(
             num_channels = self.volume.shape[3] if len(self.volume.shape) > 3 else 1,
             layer_type = self.layer_type,
             data_type = str(self.volume.dtype),  # Channel images might be 'uint8'
-            encoding = 'raw',                    # raw, jpeg, compressed_segmentation, fpzip, kempressed
+            encoding = encoding,                 # raw, jpeg, compressed_segmentation, fpzip, kempressed
             resolution = self.scales,            # Voxel scaling, units are in nanometers
             voxel_offset = self.offset,          # x,y,z offset in voxels from the origin
-            chunk_size = [64,64,64],           # units are voxels
+            chunk_size = [128,128,64],           # units are voxels
             volume_size = self.volume.shape[:3], # e.g. a cubic millimeter dataset
         )
         self.precomputed_vol = CloudVolume(f'file://{path}', mip=0, info=info, compress=True, progress=True)
         self.precomputed_vol.commit_info()
+        # write the chunks with all the cores instead of one at a time
+        self.precomputed_vol.parallel = os.cpu_count()
         self.precomputed_vol[:, :, :] = self.volume[:, :, :]
 
     def add_segment_properties(self, ids):
@@ -186,13 +192,13 @@ class AtlasCreator:
             origin = np.loadtxt(os.path.join(origin_dir, origin_file))
             x,y,z = brain_to_atlas_transform(origin, self.R, self.t)
 
-            volume = np.load(os.path.join(volume_dir, volume_file))
-            volume = volume.astype(np.uint32)
-            volume[volume > 0] = allen_color
-            xs,ys,zs = np.where(volume != 0)
+            # keep the structure as a bool mask, the color only gets added where it is set
+            volume = np.load(os.path.join(volume_dir, volume_file), mmap_mode='r')
+            volume = volume > 0
+            xs,ys,zs = np.where(volume)
             preshape = volume.shape
             try:
-                volume = volume[min(xs):max(xs)+1,min(ys):max(ys)+1,min(zs):max(zs)+1] 
+                volume = volume[xs.min():xs.max()+1,ys.min():ys.max()+1,zs.min():zs.max()+1]
             except:
                 pass
             ids[structure] = allen_color
@@ -212,7 +218,8 @@ class AtlasCreator:
                 print(f'color={allen_color} ids={volume_ids} counts={counts}')
             #continue
             try:
-                atlas_volume[row_start:row_end, col_start:col_end, z_start:z_end] += volume
+                atlas_slice = atlas_volume[row_start:row_end, col_start:col_end, z_start:z_end]
+                np.add(atlas_slice, allen_color, out=atlas_slice, where=volume)
             except ValueError as ve:
                 print(f'Error adding {structure} to atlas: {ve}')
         
@@ -38,13 +38,14 @@ class NgConverter(NumpyToNeuroglancer):
             resolution=self.scales,            # Voxel scaling, units are in nanometers
             # x,y,z offset in voxels from the origin
             voxel_offset=self.offset - np.array([1, 1, 1]),
-            chunk_size=[64, 64, 64],           # units are voxels
+            chunk_size=[128, 128, 64],           # units are voxels
             # e.g. a cubic millimeter dataset
             volume_size=self.volume.shape[:3],
         )
         self.precomputed_vol = CloudVolume(
             f'file://{path}', mip=0, info=info, compress=True, progress=True)
         self.precomputed_vol.commit_info()
+        self.precomputed_vol.parallel = os.cpu_count()
         self.precomputed_vol[:, :, :] = self.volume
 
     def create_neuroglancer_files(self, output_dir, segment_properties):
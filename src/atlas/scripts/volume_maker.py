@@ -13,6 +13,7 @@ import cv2
 import numpy as np
 from scipy.ndimage.measurements import center_of_mass
 
+from library.registration.brain_structure_manager import get_origin_and_section_size
 from library.utilities.volume2contour import average_masks
 
 class VolumeMaker:
@@ -26,42 +27,40 @@ class VolumeMaker:
             vertices = np.array(contour_points) - origin[:2]
             contour_points = (vertices).astype(np.int32)
             volume_slice = np.zeros(section_size, dtype=np.uint8)
-            volume_slice = cv2.polylines(volume_slice, [contour_points], isClosed=True, color=1, thickness=1)
             volume_slice = cv2.fillPoly(volume_slice, pts=[contour_points], color=1)
             volume.append(volume_slice)
         volume = np.array(volume).astype(np.bool8)
         volume = np.swapaxes(volume,0,2)
         for _ in range(interpolate):
             volume, origin = self.interpolate_volumes(volume,origin)
+        volume = volume > 0
         self.origins[segmenti] = origin
-        self.volumes[segmenti] = volume
+        # the COM is done on the full mask, after that the volume is only kept packed at 1 bit per voxel
+        self.coms[segmenti] = np.array(center_of_mass(volume))
+        self.volume_shapes[segmenti] = volume.shape
+        self.volumes[segmenti] = np.packbits(volume, axis=-1)
+
+    def get_volume(self, segmenti):
+        """Unpack the stored bit volume of one segment back to a bool array"""
+        packed = self.volumes[segmenti]
+        length = self.volume_shapes[segmenti][-1]
+        return np.unpackbits(packed, axis=-1, count=length).view(bool)
     
     def get_origin_and_section_size(self,segment_contours):
-        section_mins = []
-        section_maxs = []
-        for _, contour_points in segment_contours.items():
-            contour_points = np.array(contour_points)
-            section_mins.append(np.min(contour_points, axis=0))
-            section_maxs.append(np.max(contour_points, axis=0))
-        min_z = min([int(i) for i in segment_contours.keys()])
-        min_x,min_y = np.min(section_mins, axis=0)
-        max_x,max_y = np.max(section_maxs, axis=0)
-        xspan = max_x - min_x
-        yspan = max_y - min_y
-        origin = np.array([min_x,min_y,min_z])
-        size = np.array([xspan,yspan]).astype(int)+5
-        return origin,size
+        origin, size = get_origin_and_section_size(segment_contours)
+        return origin, size + 5
 
     def compute_origins_and_volumes_for_all_segments(self, interpolate=0):
         self.origins = {}
         self.volumes = {}
+        self.volume_shapes = {}
+        self.coms = {}
         self.segments = self.aligned_contours.keys()
         for segmenti in self.segments:
             self.calculate_origin_and_volume_for_one_segment(segmenti, interpolate=interpolate)
     
     def get_COM_in_pixels(self,structurei):
-        com = np.array(center_of_mass(self.volumes[structurei]))
-        return (com+self.origins[structurei])
+        return (self.coms[structurei]+self.origins[structurei])
     
     def sort_contours(self,contour_for_segmenti):
         sections = [int(section) for section in contour_for_segmenti]
@@ -30,6 +30,29 @@ class AnnotationSessionController(SqlController):
         return brain_region
     
 
+    def get_brain_regions(self):
+        """returns all the active brain regions in one query
+
+        Returns:
+            dict: brain region objects keyed by abbreviation
+        """
+        brain_regions = self.session.query(BrainRegion).filter(BrainRegion.active==True).all()
+        return {brain_region.abbreviation: brain_region for brain_region in brain_regions}
+
+    def get_annotation_sessions(self, prep_id, annotator_id):
+        """returns the newest active COM session of every brain region for an animal
+        and annotator in one query, the same session get_annotation_session finds
+
+        Returns:
+            dict: annotation session objects keyed by brain region id
+        """
+        annotation_sessions = self.session.query(AnnotationSession).filter(AnnotationSession.active==True)\
+            .filter(AnnotationSession.annotation_type==AnnotationType.STRUCTURE_COM)\
+            .filter(AnnotationSession.FK_prep_id==prep_id)\
+            .filter(AnnotationSession.FK_user_id==annotator_id)\
+            .order_by(AnnotationSession.created.asc()).all()
+        return {annotation_session.FK_brain_region_id: annotation_session for annotation_session in annotation_sessions}
+
     def get_annotation_session(self, prep_id, brain_region_id, annotator_id):
         annotation_session = self.session.query(AnnotationSession).filter(AnnotationSession.active==True)\
             .filter(AnnotationSession.annotation_type==AnnotationType.STRUCTURE_COM)\
@@ -42,7 +65,7 @@ class AnnotationSessionController(SqlController):
             annotation_session = AnnotationSession(
                 FK_prep_id=prep_id,
                 FK_user_id=annotator_id,
-                FK_brain_region_id_id=brain_region_id,
+                FK_brain_region_id=brain_region_id,
                 annotation_type=AnnotationType.STRUCTURE_COM,
                 active=True,
                 created=datetime.datetime.now())
@@ -78,6 +101,33 @@ class AnnotationSessionController(SqlController):
                 .filter(StructureCOM.FK_session_id == FK_session_id).update(entry)
             self.session.commit()
 
+    def upsert_structure_coms(self, entries):
+        """Same as upsert_structure_com for a list of entries, the existing rows are
+        found in one query and everything is written in one commit.
+        """
+        if len(entries) == 0:
+            return
+        now = datetime.datetime.now()
+        entries = {entry['FK_session_id']: entry for entry in entries}
+        session_ids = list(entries.keys())
+        annotation_sessions = self.session.query(AnnotationSession)\
+            .filter(AnnotationSession.id.in_(session_ids)).all()
+        for annotation_session in annotation_sessions:
+            annotation_session.updated = now
+        structure_coms = self.session.query(StructureCOM)\
+            .filter(StructureCOM.FK_session_id.in_(session_ids)).all()
+        for structure_com in structure_coms:
+            for key, value in entries[structure_com.FK_session_id].items():
+                setattr(structure_com, key, value)
+        existing = {structure_com.FK_session_id for structure_com in structure_coms}
+        self.session.add_all([StructureCOM(**entry) for FK_session_id, entry in entries.items() 
+                              if FK_session_id not in existing])
+        try:
+            self.session.commit()
+        except Exception as e:
+            print(f'No upsert {e}')
+            self.session.rollback()
+
     def create_annotation_session(self, annotation_type, FK_user_id, FK_prep_id, FK_brain_region_id):
         data = AnnotationSession(
             annotation_type=annotation_type,
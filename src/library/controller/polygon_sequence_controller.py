@@ -48,6 +48,41 @@ class PolygonSequenceController(SqlController):
         volume = pd.DataFrame(volume)
         return volume
     
+    def get_all_volumes(self, prep_id, annotator_id):
+        """Returns the points of all the brain region volumes of an annotator
+        in one query, instead of one query per structure with get_volume
+
+        Args:
+            prep_id (str): Animal ID
+            annotator_id (int): Annotator ID
+
+        Returns:
+            DataFrame: points of all volumes with the structure_id of each point,
+            ordered by structure, section(z), then point ordering.
+        """        
+        rows = self.session.query(AnnotationSession.FK_brain_region_id, AnnotationSession.id,
+                                  PolygonSequence.x, PolygonSequence.y, PolygonSequence.z,
+                                  PolygonSequence.point_order, PolygonSequence.polygon_index)\
+            .select_from(PolygonSequence)\
+            .join(AnnotationSession, PolygonSequence.FK_session_id==AnnotationSession.id)\
+            .filter(AnnotationSession.FK_prep_id==prep_id)\
+            .filter(AnnotationSession.FK_user_id==annotator_id)\
+            .filter(AnnotationSession.active==1)\
+            .order_by(AnnotationSession.FK_brain_region_id, AnnotationSession.id)\
+            .order_by(PolygonSequence.z)\
+            .order_by(PolygonSequence.point_order)\
+                .all()
+        columns = ['structure_id', 'session_id', 'x', 'y', 'z', 'point_ordering', 'polygon_ordering']
+        points = pd.DataFrame(rows, columns=columns)
+        # like get_volume, use a single active session per structure
+        first_session = points.groupby('structure_id')['session_id'].transform('min')
+        points = points[points['session_id'] == first_session]
+        volumes = pd.DataFrame({'structure_id': points['structure_id'].to_numpy()})
+        volumes['coordinate'] = points[['x', 'y', 'z']].to_numpy().tolist()
+        volumes['point_ordering'] = points['point_ordering'].to_numpy()
+        volumes['polygon_ordering'] = points['polygon_ordering'].to_numpy()
+        return volumes
+
     def get_available_volumes_sessions(self):
         """retruns a list of available session objects that is currently active in the database
 
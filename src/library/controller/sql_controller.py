@@ -32,6 +32,17 @@ except ImportError as fe:
     raise
 
 
+def create_session():
+    """A session on the database in settings, without the animal lookups
+    and checks SqlController does in its constructor.
+
+    :return: sqlalchemy scoped session
+    """
+    connection_string = f'mysql+pymysql://{user}:{password}@{host}/{schema}?charset=utf8'
+    engine = create_engine(connection_string, poolclass=NullPool)
+    return scoped_session(sessionmaker(bind=engine))
+
+
 class SqlController(AnimalController, ElastixController, HistologyController,
                      ScanRunController, SectionsController, SlideCZIToTifController):
     """ This is the base controller class for all things SQL.  
@@ -45,9 +56,7 @@ class SqlController(AnimalController, ElastixController, HistologyController,
                 animal: object of animal to process
         """
 
-        connection_string = f'mysql+pymysql://{user}:{password}@{host}/{schema}?charset=utf8'
-        engine = create_engine(connection_string, poolclass=NullPool)
-        self.session = scoped_session(sessionmaker(bind=engine)) 
+        self.session = create_session()
         self.session.begin()
 
         if self.animal_exists(animal):
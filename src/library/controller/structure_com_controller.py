@@ -1,6 +1,7 @@
 import numpy as np
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy import func, not_
+from sqlalchemy.orm import joinedload
 
 from library.controller.sql_controller import SqlController
 from library.database_model.annotation_points import AnnotationSession, AnnotationType, StructureCOM
@@ -64,12 +65,8 @@ class StructureCOMController(SqlController):
         """
 
         sessions = self.get_available_sessions(prep_id, annotator_id)
-        coms = []
-        for session in sessions:
-            com = self.session.query(StructureCOM).join(AnnotationSession).join(BrainRegion)\
-                .filter(StructureCOM.FK_session_id == session.id).order_by(BrainRegion.abbreviation).first()
-            coms.append(com)
-        return coms
+        session_coms = self.get_session_coms([session.id for session in sessions])
+        return [session_coms.get(session.id) for session in sessions]
 
     def get_COM(self, prep_id, annotator_id=2):
         """returns the Center Of Mass of structures for a Animal ID and annotator combination
@@ -83,11 +80,8 @@ class StructureCOMController(SqlController):
         """
 
         sessions = self.get_available_sessions(prep_id, annotator_id)
-        coms = []
-        for session in sessions:
-            com = self.session.query(StructureCOM)\
-                .filter(StructureCOM.FK_session_id == session.id).first()
-            coms.append(com)
+        session_coms = self.get_session_coms([session.id for session in sessions])
+        coms = [session_coms.get(session.id) for session in sessions]
         coordinate = [[i.x, i.y, i.z] for i in coms if i is not None]
         structure = [i.session.brain_region.abbreviation for i in coms if i is not None]
         return dict(zip(structure, coordinate))
@@ -109,6 +103,23 @@ class StructureCOMController(SqlController):
             all_coms[animal] = dict(zip(names,coords))
         return all_coms        
     
+    def get_session_coms(self, session_ids):
+        """returns the first COM of each session in one query. The session and brain region
+        of every COM are loaded in the same query, so reading the abbreviation is not another trip.
+
+        Args:
+            session_ids (list): annotation session ids
+
+        Returns:
+            dict: StructureCOM keyed by session id
+        """
+        rows = self.session.query(StructureCOM)\
+            .options(joinedload(StructureCOM.session).joinedload(AnnotationSession.brain_region))\
+            .filter(StructureCOM.FK_session_id.in_(session_ids))\
+            .order_by(StructureCOM.id.desc()).all()
+        # descending, so the lowest id of each session is the one kept
+        return {row.FK_session_id: row for row in rows}
+
     def get_available_sessions(self, prep_id, annotator_id):
         sessions = self.session.query(AnnotationSession)\
             .filter(AnnotationSession.active==True)\
@@ -16,7 +16,6 @@ from timeit import default_timer as timer
 from subprocess import Popen, PIPE
 from pathlib import Path
 import SimpleITK as sitk
-from scipy.ndimage import affine_transform
 
 
 from library.database_model.elastix_transformation import ElastixTransformation
@@ -27,9 +26,13 @@ from library.utilities.utilities_mask import equalized, normalize_image
 from library.utilities.utilities_registration import (
     align_elastix,
     align_image_to_affine,
+    align_images_on_gpu,
+    align_indexed_image_to_affine,
     create_downsampled_transforms,
     create_scaled_transform,
+    gpu_available,
     parameters_to_rigid_transform,
+    set_affine_transforms,
     tif_to_png,
 )
 
@@ -306,6 +309,7 @@ class ElastixManager(FileLogger):
         return center
     
     def transform_image(self, img, T):
+        from scipy.ndimage import affine_transform
         matrix = T[:2,:2]
         offset = T[:2,2]
         offset = np.flip(offset)
@@ -415,19 +419,28 @@ class ElastixManager(FileLogger):
 
         os.makedirs(OUTPUT, exist_ok=True)
         transforms = OrderedDict(sorted(transforms.items()))
-        first_file_name = list(transforms.keys())[0]
-        infile = os.path.join(INPUT, first_file_name)
+        # all transforms go to the workers once, the tasks only carry an index into this stack
+        stacked_transforms = np.stack([np.asarray(T, dtype=np.float64) for T in transforms.values()])
         file_keys = []
-        for file, T in transforms.items():
+        for i, file in enumerate(transforms.keys()):
             infile = os.path.join(INPUT, file)
             outfile = os.path.join(OUTPUT, file)
             if os.path.exists(outfile):
                 continue
-            file_keys.append([infile, outfile, T])
+            file_keys.append((i, infile, outfile))
 
         workers = self.get_nworkers() // 2
         start_time = timer()
-        self.run_commands_concurrently(align_image_to_affine, file_keys, workers)
+        if self.gpu and gpu_available():
+            align_images_on_gpu(file_keys, stacked_transforms)
+        elif self.use_processes:
+            self.run_commands_concurrently(align_indexed_image_to_affine, file_keys, workers,
+                                           initializer=set_affine_transforms, initargs=(stacked_transforms,))
+        else:
+            # tifffile and OpenCV release the GIL while decoding, warping and encoding, so threads
+            # do the work without the fork and pickling cost of processes
+            set_affine_transforms(stacked_transforms)
+            self.run_commands_with_threads(align_indexed_image_to_affine, file_keys, workers)
         end_time = timer()
         total_elapsed_time = round((end_time - start_time),2)
         print(f'took {total_elapsed_time} seconds.')
@@ -5,7 +5,7 @@ import os
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 
-from library.utilities.utilities_mask import clean_and_rotate_image, get_image_box
+from library.utilities.utilities_mask import clean_and_rotate_image, get_image_box, set_clean_settings
 from library.utilities.utilities_process import SCALING_FACTOR, read_image, test_dir
 
 
@@ -112,21 +112,14 @@ class ImageCleaner:
             if os.path.exists(outfile):
                 continue
             maskfile = os.path.join(MASKS, file)
-            file_keys.append(
-                [
-                    infile,
-                    outfile,
-                    maskfile,
-                    rotation,
-                    flip,
-                    max_width,
-                    max_height,
-                    self.channel,
-                ]
-            )
+            file_keys.append((infile, outfile, maskfile))
 
+        # The settings are the same for every section, so they are handed to
+        # each worker once instead of being pickled with every file.
+        settings = (rotation, flip, max_width, max_height, self.channel)
         # Cleaning images takes up around 20-25GB per full resolution image
         # so we cut the workers in half here
         workers = self.get_nworkers() // 2
-        self.run_commands_concurrently(clean_and_rotate_image, file_keys, workers)
+        self.run_commands_concurrently(clean_and_rotate_image, file_keys, workers,
+                                       initializer=set_clean_settings, initargs=settings)
 
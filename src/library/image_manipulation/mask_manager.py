@@ -5,13 +5,11 @@ https://www.cis.upenn.edu/~jshi/ped_html/
 
 import os
 import numpy as np
-import torch
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 import cv2
-import torchvision
-from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
-from torchvision.models.detection.mask_rcnn import MaskRCNNPredictor
+# torch and torchvision are imported in the methods that use them, they take
+# seconds to import and most pipeline tasks never create masks
 
 from library.utilities.utilities_mask import combine_dims, merge_mask
 from library.utilities.utilities_process import test_dir, get_image_size
@@ -70,6 +68,9 @@ class MaskManager:
 
         :param num_classes: int showing how many classes, usually 2, brain tissue, not brain tissue
         """
+        import torchvision
+        from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
+        from torchvision.models.detection.mask_rcnn import MaskRCNNPredictor
 
         # load an instance segmentation model pre-trained pre-trained on COCO
         model = torchvision.models.detection.maskrcnn_resnet50_fpn(weights="DEFAULT")
@@ -101,6 +102,7 @@ class MaskManager:
     def load_machine_learning_model(self):
         """Load the CNN model used to generate image masks
         """
+        import torch
         
         modelpath = os.path.join(
             "/net/birdstore/Active_Atlas_Data/data_root/brains_info/masks/mask.model.pth"
@@ -156,6 +158,8 @@ class MaskManager:
         """Create masks for the downsampled images using a machine learning algorithm.
         The input files are the files that have been normalized.
         """
+        import torch
+        import torchvision
         
         self.load_machine_learning_model()
         transform = torchvision.transforms.ToTensor()
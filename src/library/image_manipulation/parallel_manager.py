@@ -29,7 +29,7 @@ class ParallelManager:
             usecpus = cpus[hostname]
         return usecpus
 
-    def run_commands_concurrently(self, function, file_keys, workers):
+    def run_commands_concurrently(self, function, file_keys, workers, initializer=None, initargs=()):
         """This method uses the ProcessPoolExecutor library to run
         multiple processes at the same time. It also has a debug option.
         This is helpful to show errors on stdout. 
@@ -37,14 +37,21 @@ class ParallelManager:
         :param function: the function to run
         :param file_keys: tuple of file information
         :param workers: integer number of workers to use
+        :param initializer: optional function run once in each worker, used to
+            hand the workers settings that are the same for every file
+        :param initargs: tuple of arguments for the initializer
         """
         
         if self.debug:
+            if initializer is not None:
+                initializer(*initargs)
             for file_key in sorted(file_keys):
                 function(file_key)
         else:
-            with ProcessPoolExecutor(max_workers=workers) as executor:
-                executor.map(function, sorted(file_keys))
+            # send the tasks in chunks so there is not one IPC round trip per file
+            chunksize = max(1, len(file_keys) // (workers * 4))
+            with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+                executor.map(function, sorted(file_keys), chunksize=chunksize)
                 executor.shutdown(wait=True)
 
 
@@ -62,7 +62,7 @@ class Pipeline(
     # animal, rescan_number=0, channel=1, iterations=iterations, downsample=False, tg=False, task='status', debug=False)
 
     def __init__(self, animal, rescan_number=0, channel=1, iterations=2, downsample=False, 
-                 tg=False, task='status', debug=False):
+                 tg=False, task='status', debug=False, use_processes=False, gpu=False):
         """Setting up the pipeline and the processing configurations
         Here is how the Class is instantiated:
             pipeline = Pipeline(animal, self.channel, downsample, data_path, tg, debug)
@@ -83,6 +83,8 @@ class Pipeline(
             downsample (bool, optional): Determine if we are working on the full resolution or downsampled version. Defaults to True.
             data_path (str, optional): path to where the images and intermediate steps are stored. Defaults to '/net/birdstore/Active_Atlas_Data/data_root'.
             debug (bool, optional): determine if we are in debug mode.  This is used for development purposes. Defaults to False. (forces processing on single core)
+            use_processes (bool, optional): align images with a process pool instead of threads. Defaults to False.
+            gpu (bool, optional): align images on a CUDA device when OpenCV has one. Defaults to False.
         """
         self.task = task
         self.animal = animal
@@ -91,6 +93,8 @@ class Pipeline(
         self.iterations = iterations
         self.downsample = downsample
         self.debug = debug
+        self.use_processes = use_processes
+        self.gpu = gpu
         self.fileLocationManager = FileLocationManager(animal, data_path=data_path)
         self.sqlController = SqlController(animal, rescan_number)
         self.session = self.sqlController.session
@@ -6,6 +6,7 @@ to the image brain. It prints out the data by default and also will insert
 into the database if given a layer name.
 """
 import os
+from datetime import datetime
 import numpy as np
 from collections import defaultdict
 from skimage.filters import gaussian
@@ -16,9 +17,18 @@ from library.registration.algorithm import brain_to_atlas_transform, umeyama
 from library.utilities.atlas import volume_to_polygon, save_mesh
 from library.utilities.atlas import singular_structures
 from library.registration.brain_structure_manager import BrainStructureManager
-from library.controller.structure_com_controller import StructureCOMController
-from library.controller.annotation_session_controller import AnnotationSessionController
-from library.database_model.annotation_points import AnnotationType, StructureCOM
+from library.database_model.annotation_points import AnnotationSession, AnnotationType, StructureCOM
+from library.database_model.brain_region import BrainRegion
+
+
+def unpack_volume(packed, n):
+    """Unpacks a bool volume stored with np.packbits along the last axis
+
+    :param packed: uint8 array from np.packbits(volume, axis=-1)
+    :param n: length of the last axis of the original volume
+    :return: bool volume
+    """
+    return np.unpackbits(packed, axis=-1, count=n).view(bool)
 
 
 class BrainMerger():
@@ -55,7 +65,14 @@ class BrainMerger():
         xl, yl, zl = size_difference - np.array([xr, yr, zr])
         return np.pad(volume, [[xl, xr], [yl, yr], [zl, zr]])
 
+    def add_volume(self, structure, volume):
+        """Keeps a structure volume for merging, packed to one bit per voxel
+        as there are dozens of them held until all the brains are done.
+        """
+        self.volumes_to_merge[structure].append((np.packbits(volume, axis=-1), volume.shape[-1]))
+
     def merge_volumes(self, structure, volumes):
+        volumes = [unpack_volume(packed, n) for packed, n in volumes]
         lvolumes = len(volumes)
         if lvolumes == 1:
             print(f'{structure} has only one volume')
@@ -71,10 +88,8 @@ class BrainMerger():
             # increasing the STD makes the volume smoother
             # Smooth the probability
             average_volume = gaussian(merged_volume_prob, 3.0)
-            color = 1
-            average_volume[average_volume > self.threshold] = color
-            average_volume[average_volume != color] = 0
-            average_volume = average_volume.astype(np.uint8)
+            # one compare instead of two masked writes and a cast
+            average_volume = (average_volume > self.threshold).view(np.uint8)
             return average_volume
         else:
             print(f'{structure} has no volumes to merge')
@@ -112,25 +127,37 @@ class BrainMerger():
 
 
     def save_coms_to_db(self):
-        """Saves COMs to DB
+        """Saves COMs to DB. The sessions and COMs for all structures
+        are written in one transaction instead of two commits per structure.
         """
         animal = 'Atlas'
         brainManager = BrainStructureManager(animal)
         source = 'MANUAL'
         brainManager.inactivate_coms(animal)
-        structureController = StructureCOMController(animal)
-        annotationSessionController = AnnotationSessionController(animal)
+        session = brainManager.sqlController.session
+        brain_regions = {r.abbreviation: r.id for r in session.query(BrainRegion).all()}
 
+        com_rows = []
         for abbreviation in self.coms.keys():
             point = self.coms[abbreviation]
             #origin = self.origins[abbreviation]
-            FK_brain_region_id = structureController.structure_abbreviation_to_id(abbreviation=abbreviation)
-            FK_session_id = annotationSessionController.create_annotation_session(annotation_type=AnnotationType.STRUCTURE_COM, 
-                                                                                    FK_user_id=1, FK_prep_id=animal, FK_brain_region_id=FK_brain_region_id)
+            FK_brain_region_id = brain_regions.get(abbreviation)
+            if FK_brain_region_id is None:
+                print(f'No structure found for {abbreviation}')
+                continue
+            annotation_session = AnnotationSession(annotation_type=AnnotationType.STRUCTURE_COM, 
+                                                   FK_user_id=1, FK_prep_id=animal, FK_brain_region_id=FK_brain_region_id,
+                                                   created=datetime.now(), active=True)
             x,y,z = (p*25 for p in point)
             #minx, miny, minz = (p for p in origin)
-            com = StructureCOM(source=source, x=x, y=y, z=z, FK_session_id=FK_session_id)
-            brainManager.sqlController.add_row(com)
+            com_rows.append(StructureCOM(source=source, x=x, y=y, z=z, session=annotation_session))
+
+        try:
+            session.add_all(com_rows)
+            session.commit()
+        except Exception as e:
+            print(f'Could not save COMs {e}')
+            session.rollback()
 
 
     # should be static
@@ -1,21 +1,127 @@
 import os
 import sys
 import numpy as np
-from collections import defaultdict
-import cv2
 import json
-from scipy.ndimage import center_of_mass
+from concurrent.futures import ProcessPoolExecutor
 
 
 from library.controller.polygon_sequence_controller import PolygonSequenceController
 from library.controller.sql_controller import SqlController
 from library.controller.structure_com_controller import StructureCOMController
 from library.image_manipulation.filelocation_manager import data_path, FileLocationManager
-from library.registration.algorithm import brain_to_atlas_transform, umeyama
+from library.registration.algorithm import umeyama
 from library.utilities.atlas import volume_to_polygon, save_mesh, allen_structures
 from library.controller.annotation_session_controller import AnnotationSessionController
 
 
+STRUCTURE_SETTINGS = {}
+
+
+def set_structure_settings(R, t, allen_um):
+    """Stores the rigid transform to the fixed brain and the atlas resolution for
+    compute_structure_volume. This is the initializer of each worker process,
+    so these are handed over once per worker instead of once per structure.
+    """
+    STRUCTURE_SETTINGS['R'] = R
+    STRUCTURE_SETTINGS['t'] = t
+    STRUCTURE_SETTINGS['allen_um'] = allen_um
+    STRUCTURE_SETTINGS['volume_buffer'] = None
+
+
+def get_origin_and_section_size(structure_contours):
+    """Gets the origin and section size
+    Set the pad to make sure we get all the volume
+    """
+    # one (N, 2) array of all the section points, reduced once instead of per section
+    points = np.concatenate([np.asarray(contour_points, dtype=np.float64).reshape(-1, 2) 
+                             for contour_points in structure_contours.values()])
+    min_z = min([int(i) for i in structure_contours.keys()])
+    min_x, min_y = points.min(axis=0)
+    max_x, max_y = points.max(axis=0)
+
+    xspan = max_x - min_x
+    yspan = max_y - min_y
+    origin = np.array([min_x, min_y, min_z])
+    section_size = np.array([xspan, yspan]).astype(int)
+    return origin, section_size
+
+
+def get_volume_buffer(shape):
+    """Returns a zeroed uint8 view of the rasterization buffer. The buffer is
+    kept across the structures a worker gets and only reallocated when a 
+    structure is larger than any before it.
+    """
+    shape = tuple(int(s) for s in shape)
+    volume_buffer = STRUCTURE_SETTINGS.get('volume_buffer')
+    if volume_buffer is None:
+        volume_buffer = np.zeros(shape, dtype=np.uint8)
+    elif any(b < s for b, s in zip(volume_buffer.shape, shape)):
+        buffer_shape = np.maximum(shape, volume_buffer.shape)
+        volume_buffer = np.zeros(tuple(buffer_shape), dtype=np.uint8)
+    STRUCTURE_SETTINGS['volume_buffer'] = volume_buffer
+    volume = volume_buffer[:shape[0], :shape[1], :shape[2]]
+    volume.fill(0)
+    return volume
+
+
+def center_of_mass(volume):
+    """The center of mass of the bool volume, done with the first moments along
+    each axis instead of scipy's labeled center_of_mass, which casts the volume to float.
+    The values are NaN for an empty volume.
+    """
+    if volume.dtype == bool:
+        volume = volume.view(np.uint8)
+    total = volume.sum(dtype=np.int64)
+    com = np.full(volume.ndim, np.nan)
+    if total > 0:
+        for axis in range(volume.ndim):
+            other_axes = tuple(i for i in range(volume.ndim) if i != axis)
+            marginal = volume.sum(axis=other_axes, dtype=np.int64)
+            com[axis] = marginal @ np.arange(volume.shape[axis], dtype=np.int64) / total
+    return com
+
+
+def compute_structure_volume(file_key):
+    """Transforms the polygon points of one structure to the fixed brain, rasterizes
+    them into a bool volume and gets its center of mass. The transform comes from
+    set_structure_settings.
+
+    :param file_key: tuple of the structure abbreviation, the (N, 3) polygon points in um
+        and the polygon index of each point
+    :return: tuple of abbreviation, origin, volume and center of mass relative to the origin
+    """
+    import cv2
+    abbreviation, coords, polygon_index = file_key
+    R = STRUCTURE_SETTINGS['R']
+    t = STRUCTURE_SETTINGS['t']
+    # transform all points to fixed brain um with rigid transform in one matmul
+    # and scale transformed points to 25um
+    xyz = ((R @ coords.T).T + t.ravel()) / STRUCTURE_SETTINGS['allen_um']
+    sections = np.round(xyz[:, 2]).astype(np.int32)
+    # group the xy points by section then polygon, keeping the point order within each polygon
+    order = np.lexsort((polygon_index, sections))
+    section_ids, starts = np.unique(sections[order], return_index=True)
+    polygons = dict(zip(section_ids.tolist(), np.split(xyz[order, :2], starts[1:])))
+    section_polygon_index = dict(zip(section_ids.tolist(), np.split(polygon_index[order], starts[1:])))
+
+    color = 1 # on/off
+    origin, section_size = get_origin_and_section_size(polygons)
+    # one buffer for the whole structure, each section is filled in place
+    volume = get_volume_buffer((len(polygons), *section_size))
+    for k, (section, contour_points) in enumerate(sorted(polygons.items())):
+        # subtract origin so the array starts drawing in the upper top left
+        # the points are floats, so subtract before truncating to int32
+        vertices = (np.asarray(contour_points) - origin[:2]).astype(np.int32)
+        # each polygon of the section is its own contour, all filled in one call
+        _, polygon_starts = np.unique(section_polygon_index[section], return_index=True)
+        contours = np.split(vertices, polygon_starts[1:])
+        # fillPoly also draws the boundary, so no polylines is needed
+        cv2.fillPoly(volume[k], pts=contours, color=color)
+    volume = volume.astype(np.bool8)
+    volume = np.swapaxes(volume,0,2)
+    com = center_of_mass(volume)
+    return abbreviation, origin, volume, com
+
 
 class BrainStructureManager():
 
@@ -91,8 +197,12 @@ class BrainStructureManager():
 
         fixed_coms = self.fixed_brain.get_coms(annotator_id=self.fixed_brain.com_annotator_id)
         common_keys = sorted(fixed_coms.keys() & moving_coms.keys() & area_keys)
-        fixed_points = np.array([fixed_coms[s] for s in common_keys])
-        moving_points = np.array([moving_coms[s] for s in common_keys])
+        # fill float32 arrays directly so umeyama gets one dtype and no lists of lists
+        fixed_points = np.empty((len(common_keys), 3), dtype=np.float32)
+        moving_points = np.empty((len(common_keys), 3), dtype=np.float32)
+        for i, s in enumerate(common_keys):
+            fixed_points[i] = fixed_coms[s]
+            moving_points[i] = moving_coms[s]
 
         #fixed_points /= 25
         #moving_points /= 25
@@ -110,21 +220,7 @@ class BrainStructureManager():
         """Gets the origin and section size
         Set the pad to make sure we get all the volume
         """
-        section_mins = []
-        section_maxs = []
-        for _, contour_points in structure_contours.items():
-            contour_points = np.array(contour_points)
-            section_mins.append(np.min(contour_points, axis=0))
-            section_maxs.append(np.max(contour_points, axis=0))
-        min_z = min([int(i) for i in structure_contours.keys()])
-        min_x, min_y = np.min(section_mins, axis=0)
-        max_x, max_y = np.max(section_maxs, axis=0)
-
-        xspan = max_x - min_x
-        yspan = max_y - min_y
-        origin = np.array([min_x, min_y, min_z])
-        section_size = np.array([xspan, yspan]).astype(int)
-        return origin, section_size
+        return get_origin_and_section_size(structure_contours)
 
 
     def compute_origin_and_volume_for_brain_structures(self, brainManager, brainMerger, polygon_annotator_id):
@@ -138,62 +234,49 @@ class BrainStructureManager():
             print(f'R is empty with {self.animal} ID={polygon_annotator_id}')
             return
 
-        # loop through structure objects
-        for structure in structures:
-            self.abbreviation = structure.abbreviation
+        # all the polygons in one query, grouped by structure
+        all_volumes = polygon.get_all_volumes(self.animal, polygon_annotator_id)
+        volumes = dict(tuple(all_volumes.groupby('structure_id')))
 
+        file_keys = []
+        for structure in structures:
             #if structure.abbreviation not in self.allen_structures_keys:
             #    continue
-            
-            df = polygon.get_volume(self.animal, polygon_annotator_id, structure.id)
-            if df.empty:
+            df = volumes.get(structure.id)
+            if df is None or df.empty:
                 continue;
+            coords = np.vstack(df['coordinate'].to_numpy()).astype(np.float64, copy=False)
+            polygon_index = df['polygon_ordering'].fillna(0).to_numpy(dtype=np.int64)
+            file_keys.append((structure.abbreviation, coords, polygon_index))
+
+        # the structures are independent, so they are rasterized in parallel
+        # and handed to the merger in structure order
+        if self.debug:
+            set_structure_settings(R, t, self.allen_um)
+            results = [compute_structure_volume(file_key) for file_key in file_keys]
+        else:
+            workers = max(1, min(os.cpu_count(), len(file_keys)))
+            with ProcessPoolExecutor(max_workers=workers, initializer=set_structure_settings, 
+                                     initargs=(R, t, self.allen_um)) as executor:
+                results = list(executor.map(compute_structure_volume, file_keys))
 
-            #####TRANSFORMED point dictionary
-            polygons = defaultdict(list)
-
-            for _, row in df.iterrows():
-                x = row['coordinate'][0] 
-                y = row['coordinate'][1] 
-                z = row['coordinate'][2]
-                # transform points to fixed brain um with rigid transform
-                x,y,z = brain_to_atlas_transform((x,y,z), R, t)
-                # scale transformed points to 25um
-                x /= self.allen_um
-                y /= self.allen_um
-                z /= self.allen_um
-                xy = (x, y)
-                section = int(np.round(z))
-                polygons[section].append(xy)
-
-            color = 1 # on/off
-            origin, section_size = self.get_origin_and_section_size(polygons)
-            volume = []
-            for _, contour_points in polygons.items():
-                vertices = np.array(contour_points)
-                # subtract origin so the array starts drawing in the upper top left
-                vertices = np.array(contour_points) - origin[:2]
-                contour_points = (vertices).astype(np.int32)
-                volume_slice = np.zeros(section_size, dtype=np.uint8)
-                volume_slice = cv2.polylines(volume_slice, [contour_points], isClosed=True, color=color, thickness=1)
-                volume_slice = cv2.fillPoly(volume_slice, pts=[contour_points], color=color)
-                volume.append(volume_slice)
-            volume = np.array(volume).astype(np.bool8)
-            volume = np.swapaxes(volume,0,2)
+        for abbreviation, origin, volume, com in results:
             # set structure object values
-            self.abbreviation = structure.abbreviation
+            self.abbreviation = abbreviation
             self.origin = origin
             self.volume = volume
             # Add origin and com
-            self.com = np.array(self.get_center_of_mass()) + np.array(self.origin)
-            brainMerger.volumes_to_merge[structure.abbreviation].append(self.volume)
-            brainMerger.origins_to_merge[structure.abbreviation].append(self.origin)
-            brainMerger.coms_to_merge[structure.abbreviation].append(self.com)
-            # debug info
-            ids, counts = np.unique(volume, return_counts=True)
+            if np.isnan(np.sum(com)):
+                com = self.get_center_of_mass()
+            self.com = np.array(com) + np.array(self.origin)
+            brainMerger.add_volume(abbreviation, self.volume)
+            brainMerger.origins_to_merge[abbreviation].append(self.origin)
+            brainMerger.coms_to_merge[abbreviation].append(self.com)
             print(polygon_annotator_id, self.animal, self.abbreviation, self.origin, self.com, end="\t")
-            print(volume.dtype, volume.shape, end="\t")
-            print(ids, counts)
+            print(volume.dtype, volume.shape)
+            if self.debug:
+                ids, counts = np.unique(volume, return_counts=True)
+                print(ids, counts)
 
 
     def inactivate_coms(self, animal):
@@ -233,6 +316,8 @@ class BrainStructureManager():
 
 
     def get_center_of_mass(self):
+        """center_of_mass of self.volume, an empty volume prints what it holds and gets 0,0,0
+        """
         com = center_of_mass(self.volume)
         sum_ = np.isnan(np.sum(com))
         if sum_:
@@ -1,6 +1,26 @@
 import numpy as np
 import SimpleITK as sitk
 
+
+def apply_transform_to_points(transform, points):
+    """Applies a SimpleITK transform to an (N, dimension) array of points.
+    A linear transform (rigid, similarity, affine) is read back as its matrix
+    and offset by transforming the origin and the unit vectors, and then applied
+    to all the points with one matmul. Other transforms go point by point.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) == 0 or not transform.IsLinear():
+        transformed = np.zeros(points.shape)
+        for i in range(points.shape[0]):
+            transformed[i] = transform.TransformPoint(points[i,:])
+        return transformed
+    dimension = points.shape[1]
+    offset = np.array(transform.TransformPoint((0.0,) * dimension))
+    matrix = np.column_stack([np.array(transform.TransformPoint(tuple(unit))) - offset 
+                              for unit in np.eye(dimension)])
+    return points @ matrix.T + offset
+
+
 class Registration:
     '''
     Contains methods related to image registration
@@ -50,17 +70,11 @@ class Registration:
 
     def transform_points(self,points):
         self.get_inverse_transform()
-        transformed=np.zeros(points.shape)
-        for i in range(points.shape[0]):
-            transformed[i]=self.inverse_transform.TransformPoint(points[i,:])
-        return transformed
+        return apply_transform_to_points(self.inverse_transform, points)
     
     def inverse_transform_points(self,points):
         self.get_transform()
-        transformed=np.zeros(points.shape)
-        for i in range(points.shape[0]):
-            transformed[i]=self.transform.TransformPoint(points[i,:])
-        return transformed
+        return apply_transform_to_points(self.transform, points)
     
     def get_transformed_moving_point(self):
         return self.transform_points(self.moving)
\ No newline at end of file
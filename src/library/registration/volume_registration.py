@@ -24,8 +24,10 @@ pred  SC: 369, 64, 219
 TODO, transform polygons in DB using the transformation below
 """
 
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import os
+import shutil
 import sys
 import numpy as np
 from skimage import io
@@ -33,33 +35,43 @@ from skimage import io
 #from skimage.exposure import rescale_intensity
 #from allensdk.core.mouse_connectivity_cache import MouseConnectivityCache
 from tqdm import tqdm
+# ITK reads the thread count when it is first loaded, so set it before the import
+os.environ.setdefault('ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', str(os.cpu_count()))
 import SimpleITK as sitk
 from taskqueue import LocalTaskQueue
 import igneous.task_creation as tc
 import pandas as pd
 import cv2
+import tifffile
 
 from library.controller.polygon_sequence_controller import PolygonSequenceController
-from library.controller.sql_controller import SqlController
+from library.controller.sql_controller import SqlController, create_session
+from library.database_model.scan_run import ScanRun
 from library.controller.annotation_session_controller import AnnotationSessionController
 from library.controller.structure_com_controller import StructureCOMController
 from library.image_manipulation.neuroglancer_manager import NumpyToNeuroglancer
 from library.image_manipulation.filelocation_manager import FileLocationManager
-from library.utilities.utilities_mask import normalize8, smooth_image
+from library.utilities.utilities_kernels import dice_counts
+from library.utilities.utilities_mask import normalize8_lut, smooth_image
 from library.utilities.utilities_process import read_image
 from library.registration.brain_structure_manager import BrainStructureManager
 from library.registration.brain_merger import BrainMerger
 
 # constants
 MOVING_CROP = 50
+# the rigid, affine and bspline stages write TransformParameters.0-2.txt,
+# older runs had a translation stage first and wrote TransformParameters.0-3.txt.
+# Both layouts have this file once the registration is done.
+LAST_TRANSFORM_FILE = 'TransformParameters.2.txt'
 
 
-def sort_from_center(polygon:list) -> list:
+def sort_from_center(polygon) -> np.ndarray:
     """Get the center of the unique points in a polygon and then use math.atan2 to get
     the angle from the x-axis to the x,y point. Use that to sort.
     This only works with convex shaped polygons.
     
-    :param polygon:
+    :param polygon: list or numpy array of x,y points
+    :return: numpy array of the unique points in order
     """
 
     coords = np.array(polygon)
@@ -67,8 +79,7 @@ def sort_from_center(polygon:list) -> list:
     center = coords.mean(axis=0)
     centered = coords - center
     angles = -np.arctan2(centered[:, 1], centered[:, 0])
-    sorted_coords = coords[np.argsort(angles)]
-    return list(map(tuple, sorted_coords))
+    return coords[np.argsort(angles)]
 
 
 def dice(im1, im2):
@@ -91,16 +102,109 @@ def dice(im1, im2):
     -----
     The order of inputs for `dice` is irrelevant. The result will be
     identical if `im1` and `im2` are switched.
+    The volumes are packed to bits and the counts are done on the packed bytes.
     """
-    im1 = np.asarray(im1).astype(bool)
-    im2 = np.asarray(im2).astype(bool)
+    im1 = np.asarray(im1)
+    im2 = np.asarray(im2)
 
     if im1.shape != im2.shape:
         raise ValueError("Shape mismatch: im1 and im2 must have the same shape.")
 
+    # packbits sets a bit for every nonzero integer, only floats need a comparison
+    if im1.dtype.kind not in 'biu':
+        im1 = im1 != 0
+    if im2.dtype.kind not in 'biu':
+        im2 = im2 != 0
+    a = np.packbits(im1, axis=None)
+    b = np.packbits(im2, axis=None)
+
     # Compute Dice coefficient
-    intersection = np.logical_and(im1, im2)
-    return 2. * intersection.sum() / (im1.sum() + im2.sum())
+    intersection, sa, sb = dice_counts(a, b)
+    return 2. * intersection / np.float64(sa + sb)
+
+def get_transform_files(outputpath, bspline=False):
+    """The transform parameter files transformix applies, in order.
+    A registration writes rigid, affine and bspline to files 0-2. Older runs
+    started with a translation stage, wrote files 0-3 and transformix applied
+    translation, rigid and affine (0-2), the rigid stage was estimated on top
+    of the translation so it stays in the chain. The layout is told from the
+    transform in file 0, so a stale file from another run does not matter.
+
+    :param outputpath: elastix output directory
+    :param bspline: also return the bspline file
+    :return: list of paths
+    """
+    first = read_parameter_file(os.path.join(outputpath, 'TransformParameters.0.txt'))
+    if first['Transform'][0] == 'TranslationTransform':
+        indexes = [0, 1, 2, 3] if bspline else [0, 1, 2]
+    else:
+        indexes = [0, 1, 2] if bspline else [0, 1]
+    return [os.path.join(outputpath, f'TransformParameters.{i}.txt') for i in indexes]
+
+
+def write_point_file(path, points, fmt='%.4f'):
+    """Writes points straight to an elastix/transformix point file, no
+    point set object is built first:
+    point
+    3
+    102.8 -33.4 57.0
+
+    :param path: path of the .pts file
+    :param points: numpy array of shape (n, 3)
+    :param fmt: numpy format of a coordinate
+    """
+    with open(path, 'w') as f:
+        f.write(f'point\n{len(points)}\n')
+        np.savetxt(f, points, fmt=fmt)
+
+
+def read_output_points(path):
+    """Reads the OutputPoint x,y,z columns of a transformix outputpoints.txt file.
+    Every line has the same layout so the columns are parsed by position:
+    Point 0 ; InputIndex = [ i j k ] ; InputPoint = [ x y z ] ; OutputIndexFixed = [ i j k ] ; OutputPoint = [ x y z ] ...
+
+    The pandas C parser is used, it is much faster than np.loadtxt on large files.
+
+    :param path: path of outputpoints.txt
+    :return: numpy float64 array of shape (n, 3)
+    """
+    points = pd.read_csv(path, sep=r'\s+', header=None, usecols=[30, 31, 32], engine='c')
+    return points.to_numpy(dtype=np.float64)
+
+
+@lru_cache(maxsize=8)
+def cached_parameter_file(path, mtime):
+    """Parses an elastix parameter file once. The mtime is part of the cache key
+    so a file written again by a new registration is read again.
+
+    :param path: path of the parameter file
+    :param mtime: modification time of the file
+    :return: SimpleITK parameter map
+    """
+    return sitk.ReadParameterFile(path)
+
+
+def read_parameter_file(path):
+    """Returns the parsed parameter map, only parsing the file when it has changed
+
+    :param path: path of the parameter file
+    :return: SimpleITK parameter map
+    """
+    return cached_parameter_file(path, os.path.getmtime(path))
+
+
+def memmap_volume(path):
+    """Maps an uncompressed TIFF volume read only instead of reading it all into memory.
+    Compressed or tiled files can't be mapped and are read with tifffile.
+
+    :param path: path of the TIFF
+    :return: numpy array or read only numpy memmap
+    """
+    try:
+        return tifffile.memmap(path, mode='r')
+    except ValueError:
+        return tifffile.imread(path)
+
 
 def pad_volume(volume, padto):
     re = (padto[2] - volume.shape[2]) // 1
@@ -146,6 +250,14 @@ class VolumeRegistration:
         self.unregistered_point_file = os.path.join(self.data_path, f'{self.animal}_{um}um_{orientation}_unregistered.pts')
         self.neuroglancer_data_path = os.path.join(self.fileLocationManager.neuroglancer_data, f'{self.channel}_{self.fixed}{um}um')
         self.number_of_sampling_attempts = "10"
+        self.number_of_spatial_samples = "16000"
+        self.image_cache = {}
+        # transform parameter maps of registrations run by this instance, keyed by output dir
+        self.transform_parameter_maps = {}
+        # (xy, z) resolution of the moving animal's scan run, see get_scan_run_resolution
+        self.scan_run_resolution = None
+        # elastix runs the metric and sampler on all the cores
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(os.cpu_count())
         if self.debug:
             iterations = "100"
             self.number_of_resolutions = "4"
@@ -153,7 +265,8 @@ class VolumeRegistration:
             self.affineIterations = iterations
             self.bsplineIterations = iterations
         else:
-            self.number_of_resolutions = "6"
+            # 4 pyramid levels do as well as 6 on these volumes and skip the slowest coarse levels
+            self.number_of_resolutions = "4"
             self.rigidIterations = "1000"
             self.affineIterations = "2500"
             self.bsplineIterations = "15000"
@@ -164,36 +277,86 @@ class VolumeRegistration:
  
 
 
-    def setup_transformix(self, outputpath):
-        """Method used to transform volumes and points
+    def read_volume(self, path, pixel_type=sitk.sitkUnknown):
+        """Reads a volume with SimpleITK once per instance. The cached image
+        is only read again if the file has changed on disk.
+
+        :param path: path of the volume
+        :param pixel_type: SimpleITK pixel type to read the volume as
+        :return: SimpleITK image
+        """
+        key = (path, pixel_type)
+        mtime = os.path.getmtime(path)
+        cached = self.image_cache.get(key)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, sitk.ReadImage(path, pixel_type))
+            self.image_cache[key] = cached
+        return cached[1]
+
+
+    def setup_transformix(self, outputpath, bspline=False):
+        """Method used to transform volumes and points.
+        Transformix applies the rigid and affine maps, the bspline deformation
+        is only added when asked for.
+
+        :param outputpath: elastix output directory with the transform parameter files
+        :param bspline: also apply the bspline map
         """
         
         os.makedirs(self.registration_output, exist_ok=True)
 
         transformixImageFilter = sitk.TransformixImageFilter()
-        parameterMap0 = sitk.ReadParameterFile(os.path.join(outputpath, 'TransformParameters.0.txt'))
-        parameterMap1 = sitk.ReadParameterFile(os.path.join(outputpath, 'TransformParameters.1.txt'))
-        parameterMap2 = sitk.ReadParameterFile(os.path.join(outputpath, 'TransformParameters.2.txt'))
-        #parameterMap3 = sitk.ReadParameterFile(os.path.join(outputpath, 'TransformParameters.3.txt'))
-        transformixImageFilter.SetTransformParameterMap(parameterMap0)
-        transformixImageFilter.AddTransformParameterMap(parameterMap1)
-        transformixImageFilter.AddTransformParameterMap(parameterMap2)
-        #transformixImageFilter.AddTransformParameterMap(parameterMap3)
+        # a registration run by this instance hands its maps over in memory,
+        # otherwise they are read from the files elastix wrote
+        parameterMaps = self.transform_parameter_maps.get(outputpath)
+        if parameterMaps is None:
+            parameterMaps = [read_parameter_file(path) for path in get_transform_files(outputpath, bspline)]
+        elif not bspline:
+            parameterMaps = parameterMaps[:2]
+        transformixImageFilter.SetTransformParameterMap(parameterMaps[0])
+        for parameterMap in parameterMaps[1:]:
+            transformixImageFilter.AddTransformParameterMap(parameterMap)
         transformixImageFilter.LogToFileOn()
         transformixImageFilter.LogToConsoleOff()
         transformixImageFilter.SetOutputDirectory(self.registration_output)
-        movingImage = sitk.ReadImage(self.moving_volume_path)
+        # float like setup_registration, so the cached image is shared and not cast again
+        movingImage = self.read_volume(self.moving_volume_path, sitk.sitkFloat32)
         transformixImageFilter.SetMovingImage(movingImage)
         return transformixImageFilter
 
-    def transformix_volume(self):
+    def transformix_volume(self, bspline=False):
         """Helper method when you want to rerun the same transform on another volume
         """
         
-        transformixImageFilter = self.setup_transformix(self.elastix_output)
+        transformixImageFilter = self.setup_transformix(self.elastix_output, bspline=bspline)
         transformixImageFilter.Execute()
         transformed = transformixImageFilter.GetResultImage()
-        sitk.WriteImage(transformed, os.path.join(self.registration_output, 'result.tif'))
+        self.write_result_image(transformed, os.path.join(self.registration_output, 'result.tif'))
+
+    def write_result_image(self, image, path):
+        """All the registered and transformed volumes are written here, once and
+        uncompressed, as they are read back straight away.
+
+        :param image: SimpleITK image
+        :param path: path of the tif file
+        """
+        sitk.WriteImage(image, path, useCompression=False)
+
+    def transformix_point_file(self, point_file, inverse=False, bspline=False):
+        """Runs the reverse registration transform on a transformix point file.
+        All the point methods go through here, the output is written to
+        outputpoints.txt in the registration output directory.
+
+        :param point_file: path of the .pts file
+        :param inverse: run transformix with ExecuteInverse
+        :param bspline: also apply the bspline map
+        """
+        transformixImageFilter = self.setup_transformix(self.reverse_elastix_output, bspline=bspline)
+        transformixImageFilter.SetFixedPointSetFileName(point_file)
+        if inverse:
+            transformixImageFilter.ExecuteInverse()
+        else:
+            transformixImageFilter.Execute()
 
     def transformix_com(self):
         """Helper method when you want to rerun the transform on a set of points.
@@ -212,33 +375,19 @@ class VolumeRegistration:
         """
         d = pd.read_pickle(self.unregistered_pickle_file)
         point_dict = dict(sorted(d.items()))
-        with open(self.unregistered_point_file, 'w') as f:
-            f.write('point\n')
-            f.write(f'{len(point_dict)}\n')
-            for _, points in point_dict.items():
-                x = points[0]/self.scaling_factor
-                y = points[1]/self.scaling_factor
-                z = points[2] # the z is not scaled
-                #print(structure, points, x,y,z)
-                f.write(f'{x} {y} {z}')
-                f.write('\n')
+        coords = np.array(list(point_dict.values()), dtype=np.float64).reshape(-1, 3)
+        coords[:, :2] /= self.scaling_factor # the z is not scaled
+        write_point_file(self.unregistered_point_file, coords)
         
-        transformixImageFilter = self.setup_transformix(self.reverse_elastix_output)
-        transformixImageFilter.SetFixedPointSetFileName(self.unregistered_point_file)
-        transformixImageFilter.Execute()
+        self.transformix_point_file(self.unregistered_point_file)
 
     
     def create_unregistered_pointfile(self):
         origin_dir = os.path.join(self.atlas_path, 'origin')
         origin_files = sorted(os.listdir(origin_dir))
         pointfile = os.path.join(self.data_path, 'Atlas_25um_sagittal_unregistered.pts')
-        with open(pointfile, 'w') as f:
-            f.write('point\n')
-            f.write(f'{len(origin_files)}\n')
-            for origin_file in origin_files:
-                x,y,z = np.loadtxt(os.path.join(origin_dir, origin_file))
-                f.write(f'{x} {y} {z}')
-                f.write('\n')
+        origins = np.array([np.loadtxt(os.path.join(origin_dir, origin_file)) for origin_file in origin_files]).reshape(-1, 3)
+        write_point_file(pointfile, origins)
         return origin_files
 
     def transformix_points(self):
@@ -260,14 +409,12 @@ class VolumeRegistration:
             print(f'{self.unregistered_point_file} does not exist, exiting.')
             sys.exit()
 
-        reverse_transformation_pfile = os.path.join(self.reverse_elastix_output, 'TransformParameters.3.txt')
+        reverse_transformation_pfile = os.path.join(self.reverse_elastix_output, LAST_TRANSFORM_FILE)
         if not os.path.exists(reverse_transformation_pfile):
             print(f'{reverse_transformation_pfile} does not exist, exiting.')
             sys.exit()
         
-        transformixImageFilter = self.setup_transformix(self.reverse_elastix_output)
-        transformixImageFilter.SetFixedPointSetFileName(self.unregistered_point_file)
-        transformixImageFilter.Execute()
+        self.transformix_point_file(self.unregistered_point_file)
 
     def transformix_origins(self):
         registered_origin_path = os.path.join(self.atlas_path, 'registered_origin')
@@ -275,19 +422,9 @@ class VolumeRegistration:
         origin_files = self.create_unregistered_pointfile()
         structures = sorted([str(origin).replace('.txt','') for origin in origin_files])
         self.transformix_points()
-        point_or_index = 'OutputPoint'
-
-        with open(self.registered_point_file, "r") as f:                
-            lines=f.readlines()
-            f.close()
-
-        point_or_index = 'OutputPoint'
-        for i in range(len(lines)):        
-            lx=lines[i].split()[lines[i].split().index(point_or_index)+3:lines[i].split().index(point_or_index)+6] #x,y,z
-            lf = [float(f) for f in lx]
-            x = lf[0]
-            y = lf[1]
-            z = lf[2]
+
+        points = read_output_points(self.registered_point_file)
+        for i, (x, y, z) in enumerate(points):
             structure = structures[i]
             print(i, structure,  int(x), int(y), int(z))
             origin_filepath = os.path.join(registered_origin_path, f'{structure}.txt')
@@ -312,34 +449,28 @@ class VolumeRegistration:
         structureController = StructureCOMController(self.moving)
         coms = structureController.get_coms(self.moving, annotator_id=com_annotator_id)
 
-        point_or_index = 'OutputPoint'
         source='COMPUTER'
         sessionController = AnnotationSessionController(self.moving)
 
-        with open(self.registered_point_file, "r") as f:                
-            lines=f.readlines()
-            f.close()
-
-
-        if len(lines) != len(coms):
-            print(f'Length of {self.registered_point_file}={len(lines)} != length of coms={len(coms)}')
+        points = read_output_points(self.registered_point_file) * self.um
+        if len(points) != len(coms):
+            print(f'Length of {self.registered_point_file}={len(points)} != length of coms={len(coms)}')
             return
 
-        point_or_index = 'OutputPoint'
-        for i in range(len(lines)):        
-            lx=lines[i].split()[lines[i].split().index(point_or_index)+3:lines[i].split().index(point_or_index)+6] #x,y,z
-            lf = [float(f) for f in lx]
-            x = lf[0] * self.um
-            y = lf[1] * self.um
-            z = lf[2] * self.um
-            com = coms[i]
+        # the brain regions and sessions are looked up once and all the COMs go in one commit
+        brain_regions = sessionController.get_brain_regions()
+        annotation_sessions = sessionController.get_annotation_sessions(self.moving, com_annotator_id)
+        entries = []
+        for i, (com, (x, y, z)) in enumerate(zip(coms, points)):
             structure = com.session.brain_region.abbreviation
            
-            brain_region = sessionController.get_brain_region(structure)
+            brain_region = brain_regions.get(structure)
             if brain_region is not None:
-                annotation_session = sessionController.get_annotation_session(self.moving, brain_region.id, com_annotator_id)
-                entry = {'source': source, 'FK_session_id': annotation_session.id, 'x': x, 'y':y, 'z': z}
-                sessionController.upsert_structure_com(entry)
+                annotation_session = annotation_sessions.get(brain_region.id)
+                if annotation_session is None:
+                    annotation_session = sessionController.get_annotation_session(self.moving, brain_region.id, com_annotator_id)
+                entry = {'source': source, 'FK_session_id': annotation_session.id, 'x': float(x), 'y': float(y), 'z': float(z)}
+                entries.append(entry)
             else:
                 print(f'No brain region found for {structure}')
 
@@ -347,67 +478,42 @@ class VolumeRegistration:
                 #lf = [round(l) for l in lf]
                 print(i, annotation_session.id, self.moving, brain_region.id, source, structure,  int(x/25), int(y/25), int(z/25))
 
+        sessionController.upsert_structure_coms(entries)
+
 
     def transformix_polygons(self):
         sqlController = SqlController(self.moving)
         polygon = PolygonSequenceController(animal=self.moving)        
         scale_xy = sqlController.scan_run.resolution
         z_scale = sqlController.scan_run.zresolution
-        #input_points = itk.PointSet[itk.F, 3].New()
-        input_points = None
         df_L = polygon.get_volume(self.moving, 38, 12)
         df_R = polygon.get_volume(self.moving, 38, 13)
-        frames = [df_L, df_R]
-        df = pd.concat(frames)
-        len_L = df_L.shape[0]
-        len_R = df_R.shape[0]
-        len_total = df.shape[0]
-        assert len_L + len_R == len_total, "Lengths of dataframes do not add up."
         
         TRANSFORMIX_POINTSET_FILE = os.path.join(self.registration_output,"transformix_input_points.txt")        
         #df = polygon.get_volume(self.moving, 3, 33)
 
-        for idx, (_, row) in enumerate(df.iterrows()):
-            x = row['coordinate'][0]/scale_xy/self.scaling_factor
-            y = row['coordinate'][1]/scale_xy/self.scaling_factor
-            z = row['coordinate'][2]/z_scale
-            point = [x,y,z]
-            input_points.GetPoints().InsertElement(idx, point)
-        del df
+        # stack the coordinates of both frames and scale them from um to the downsampled volume in one pass
+        points = np.vstack([np.vstack(df['coordinate'].to_numpy()) for df in (df_L, df_R) if len(df) > 0])
+        points = points.astype(np.float64)
+        points[:, :2] /= scale_xy * self.scaling_factor
+        points[:, 2] /= z_scale
+        del df_L, df_R
         
-        with open(TRANSFORMIX_POINTSET_FILE, "w") as f:
-            f.write("point\n")
-            f.write(f"{input_points.GetNumberOfPoints()}\n")
-            f.write(f"{point[0]} {point[1]} {point[2]}\n")
-            for idx in range(input_points.GetNumberOfPoints()):
-                point = input_points.GetPoint(idx)
-                f.write(f"{point[0]} {point[1]} {point[2]}\n")
+        write_point_file(TRANSFORMIX_POINTSET_FILE, points, fmt='%.6f')
                 
-        transformixImageFilter = self.setup_transformix(self.reverse_elastix_output)
-        transformixImageFilter.SetFixedPointSetFileName(TRANSFORMIX_POINTSET_FILE)
-        transformixImageFilter.Execute()
+        self.transformix_point_file(TRANSFORMIX_POINTSET_FILE)
         
-        polygons = defaultdict(list)
-        with open(self.registration_point_file, "r") as f:                
-            lines=f.readlines()
-            f.close()
-
-        point_or_index = 'OutputPoint'
-        for i in range(len(lines)):        
-            lx=lines[i].split()[lines[i].split().index(point_or_index)+3:lines[i].split().index(point_or_index)+6] #x,y,z
-            lf = [float(f) for f in lx]
-            x = lf[0]
-            y = lf[1]
-            z = lf[2]
-            section = int(np.round(z))
-            polygons[section].append((x,y))
-        resultImage = io.imread(os.path.join(self.registration_output, 'result.tif'))
-        resultImage = normalize8(resultImage)
+        # group the registered points by section in one pass, like fill_contours
+        registered = read_output_points(self.registered_point_file)
+        sections = np.rint(registered[:, 2]).astype(np.int32)
+        order = np.argsort(sections, kind='stable')
+        sections, starts = np.unique(sections[order], return_index=True)
+        polygons = zip(sections, np.split(registered[order, :2], starts[1:]))
+        resultImage = memmap_volume(os.path.join(self.registration_output, 'result.tif'))
+        resultImage = normalize8_lut(resultImage)
         
-        for section, points in polygons.items():
-            points = sort_from_center(points)
-            points = np.array(points)
-            points = points.astype(np.int32)
+        for section, points in polygons:
+            points = sort_from_center(points).astype(np.int32)
             cv2.fillPoly(resultImage[section,:,:], pts = [points], color = self.mask_color)
             cv2.polylines(resultImage[section,:,:], [points], isClosed=True, color=(self.mask_color), 
                           thickness=4)
@@ -431,20 +537,13 @@ class VolumeRegistration:
 
         
         TRANSFORMIX_POINTSET_FILE = os.path.join(self.registration_output,"transformix_input_points.txt")        
-        with open(TRANSFORMIX_POINTSET_FILE, "w") as f:
-            f.write("point\n")
-            f.write(f"{len(coms)}\n")
-
-            for idx, (structure, (x,y,z)) in enumerate(coms.items()):
-                x /= self.um
-                y /= self.um
-                z /= self.um
+        points = np.array(list(coms.values()), dtype=np.float64).reshape(-1, 3) / self.um
+        if self.debug:
+            for idx, (structure, (x,y,z)) in enumerate(zip(coms.keys(), points)):
                 print(idx, structure, x,y,z)
-                f.write(f"{x} {y} {z}\n")
+        write_point_file(TRANSFORMIX_POINTSET_FILE, points)
                 
-        transformixImageFilter = self.setup_transformix(self.reverse_elastix_output)
-        transformixImageFilter.SetFixedPointSetFileName(TRANSFORMIX_POINTSET_FILE)
-        transformixImageFilter.ExecuteInverse()
+        self.transformix_point_file(TRANSFORMIX_POINTSET_FILE, inverse=True)
 
 
     def fill_contours(self):
@@ -456,7 +555,6 @@ class VolumeRegistration:
         polygon = PolygonSequenceController(animal=self.moving)        
         scale_xy = sqlController.scan_run.resolution
         z_scale = sqlController.scan_run.zresolution
-        polygons = defaultdict(list)
         color = 0 # set it below the threshold set in mask class
         """
         df_L = polygon.get_volume(self.moving, 3, 12)
@@ -470,34 +568,50 @@ class VolumeRegistration:
         """
         df = polygon.get_volume(self.moving, 3, 33)
 
-        for _, row in df.iterrows():
-            x = row['coordinate'][0]
-            y = row['coordinate'][1]
-            z = row['coordinate'][2]
-            xy = (x/scale_xy/self.scaling_factor, y/scale_xy/self.scaling_factor)
-            section = int(np.round(z/z_scale))
-            polygons[section].append(xy)
-                    
-        for section, points in tqdm(polygons.items()):
+        # scale all the points in one pass and group them by section,
+        # the stable sort keeps the order of the points within a section
+        coords = np.vstack(df['coordinate'].to_numpy()).astype(np.float64)
+        xy = (coords[:, :2] / (scale_xy * self.scaling_factor)).astype(np.int32)
+        sections = np.rint(coords[:, 2] / z_scale).astype(np.int32)
+        order = np.argsort(sections, kind='stable')
+        sections, starts = np.unique(sections[order], return_index=True)
+        polygons = zip(sections, np.split(xy[order], starts[1:]))
+
+        def fill_section(section_points):
+            section, points = section_points
             file = str(section).zfill(3) + ".tif"
             inpath = os.path.join(INPUT, file)
             if not os.path.exists(inpath):
                 print(f'{inpath} does not exist')
-                continue
+                return
             img = cv2.imread(inpath, cv2.IMREAD_GRAYSCALE)
-            points = np.array(points)
-            points = points.astype(np.int32)
             cv2.fillPoly(img, pts = [points], color = color)
             outpath = os.path.join(OUTPUT, file)
-            cv2.imwrite(outpath, img)
-
-        files = sorted(os.listdir(INPUT))
-        for file in tqdm(files):
+            # the output may be a hard link to the input from an earlier run,
+            # unlink it so writing does not change the input
+            if os.path.exists(outpath):
+                os.remove(outpath)
+            cv2.imwrite(outpath, img, [cv2.IMWRITE_TIFF_COMPRESSION, 5]) # LZW
+
+        def link_section(file):
+            """Sections without a polygon are unchanged, so they are hard linked
+            and only copied when the directories are on different file systems.
+            """
             inpath = os.path.join(INPUT, file)
-            img = cv2.imread(inpath, cv2.IMREAD_GRAYSCALE)
             outpath = os.path.join(OUTPUT, file)
             if not os.path.exists(outpath):
-                cv2.imwrite(outpath, img)
+                try:
+                    os.link(inpath, outpath)
+                except OSError:
+                    shutil.copyfile(inpath, outpath)
+
+        # the time goes into decoding and encoding the sections, cv2 releases the GIL
+        # for both so the sections run on threads
+        workers = 1 if self.debug else os.cpu_count()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(tqdm(executor.map(fill_section, polygons), total=len(sections)))
+            files = sorted(os.listdir(INPUT))
+            list(tqdm(executor.map(link_section, files), total=len(files)))
 
 
     def get_file_information(self):
@@ -521,17 +635,24 @@ class VolumeRegistration:
         """Create a 3D volume of the image stack
         """
         files, volume_size, dtype = self.get_file_information()
-        image_stack = np.zeros(volume_size)
-        file_list = []
-        for ffile in tqdm(files):
-            fpath = os.path.join(self.thumbnail_aligned, ffile)
+        rows, columns, _ = volume_size
+        # the sections are written straight into the tif on disk, no stack is built in RAM
+        image_stack = tifffile.memmap(self.moving_volume_path, shape=(len(files), rows, columns), dtype=dtype)
+
+        def load_section(i):
+            fpath = os.path.join(self.thumbnail_aligned, files[i])
             farr = cv2.imread(fpath, cv2.IMREAD_GRAYSCALE)
             farr[farr > 250] = 0
             farr = smooth_image(farr)
-            file_list.append(farr)
-        image_stack = np.stack(file_list, axis = 0)
-        io.imsave(self.moving_volume_path, image_stack.astype(dtype))
+            np.copyto(image_stack[i], farr, casting='unsafe')
+
+        # cv2 releases the GIL while decoding and each thread fills its own plane
+        workers = 1 if self.debug else os.cpu_count()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(tqdm(executor.map(load_section, range(len(files))), total=len(files)))
+        image_stack.flush()
         print(f'Saved a 3D volume {self.moving_volume_path} with shape={image_stack.shape} and dtype={image_stack.dtype}')
+        del image_stack
 
     def create_precomputed(self):
         chunk = 64
@@ -545,7 +666,7 @@ class VolumeRegistration:
         scale = self.um * 1000
         scales = (scale, scale, scale)
         os.makedirs(PRECOMPUTED, exist_ok=True)
-        volume = read_image(volumepath)
+        volume = memmap_volume(volumepath)
         volume = np.swapaxes(volume, 0, 2)
         num_channels = 1
         volume_size = volume.shape
@@ -564,11 +685,18 @@ class VolumeRegistration:
         )
 
         ng.init_precomputed(PRECOMPUTED, volume_size)
-        ng.precomputed_vol[:, :, :] = volume
+        # write chunk aligned slabs of sections, each slab is read from contiguous
+        # pages of the memmap so only one slab is in RAM at a time
+        for z0 in tqdm(range(0, volume_size[2], chunk)):
+            z1 = min(z0 + chunk, volume_size[2])
+            ng.precomputed_vol[:, :, z0:z1] = np.asarray(volume[:, :, z0:z1])
         ng.precomputed_vol.cache.flush()
-        tq = LocalTaskQueue(parallel=4)
+        cpus = 1 if self.debug else max(1, os.cpu_count() - 1)
+        tq = LocalTaskQueue(parallel=cpus)
         cloudpath = f"file://{PRECOMPUTED}"
-        tasks = tc.create_downsampling_tasks(cloudpath, num_mips=2)
+        # igneous halves x and y only, downsample until the larger of them fits in one chunk
+        num_mips = max(1, int(np.ceil(np.log2(max(volume_size[:2]) / chunk))))
+        tasks = tc.create_downsampling_tasks(cloudpath, num_mips=num_mips, compress=True)
         tq.insert(tasks)
         tq.execute()
 
@@ -585,9 +713,10 @@ class VolumeRegistration:
         if self.debug:
             elastixImageFilter.PrintParameterMap()
         resultImage = elastixImageFilter.Execute()         
+        self.transform_parameter_maps[self.elastix_output] = elastixImageFilter.GetTransformParameterMap()
         resultImage = sitk.Cast(sitk.RescaleIntensity(resultImage), sitk.sitkUInt8)
 
-        sitk.WriteImage(resultImage, self.registered_volume)
+        self.write_result_image(resultImage, self.registered_volume)
         print(f'Saved img to {self.registered_volume}')
 
     def reverse_register_volume(self):
@@ -601,8 +730,66 @@ class VolumeRegistration:
         elastixImageFilter = self.setup_registration(self.moving, self.fixed)
         elastixImageFilter.SetOutputDirectory(self.reverse_elastix_output)
         elastixImageFilter.Execute()
+        self.transform_parameter_maps[self.reverse_elastix_output] = elastixImageFilter.GetTransformParameterMap()
         print(f'Done performing inverse')
 
+    def get_tissue_mask(self, image):
+        """Returns an Otsu tissue mask of the volume, background is 0 and tissue is 1.
+        It is cheap next to the registration, so it is made in memory every time.
+
+        :param image: SimpleITK image of the volume
+        :return: SimpleITK uint8 image
+        """
+        return sitk.OtsuThreshold(image, 0, 1)
+
+    def get_scan_run_resolution(self):
+        """The xy and z resolution of the moving animal's scan run in um,
+        looked up once per instance. The scan_run table is queried directly,
+        SqlController would exit for an animal that is not in the database.
+
+        :return: tuple of xy and z resolution, or None when there is no scan run
+        """
+        if self.scan_run_resolution is None:
+            session = create_session()
+            scan_run = session.query(ScanRun)\
+                .filter(ScanRun.FK_prep_id == self.moving)\
+                .filter(ScanRun.rescan_number == 0).first()
+            if scan_run is None:
+                print(f'No scan run for {self.moving}, using isotropic bspline spacing')
+            else:
+                self.scan_run_resolution = (scan_run.resolution, scan_run.zresolution)
+            session.close()
+        return self.scan_run_resolution
+
+    def get_grid_spacing_in_voxels(self, fixed):
+        """The bspline FinalGridSpacingInVoxels for the fixed volume.
+        A volume made by create_volume from the aligned stack has the section
+        thickness as its z voxel size, so the z spacing is scaled to cover the
+        same distance as x and y. Other volumes (Allen, atlas) are isotropic.
+
+        :param fixed: name of the fixed volume
+        :return: list of the x, y, z spacing as strings
+        """
+        isotropic = [f"{self.um}"] * 3
+        if fixed != self.moving:
+            return isotropic
+        resolution = self.get_scan_run_resolution()
+        if resolution is None:
+            return isotropic
+        xy_resolution, z_resolution = resolution
+        xy_um = xy_resolution * self.scaling_factor
+        z_um = z_resolution
+        sz = max(1, int(round(self.um * xy_um / z_um)))
+        return [f"{self.um}", f"{self.um}", f"{sz}"]
+
+    def register_volume_both_ways(self):
+        """Runs register_volume and then reverse_register_volume on this instance.
+        setup_registration gets its images from read_volume, so the fixed and moving
+        volumes are read once and only swapped for the reverse registration.
+        """
+        self.register_volume()
+        self.reverse_register_volume()
+
     def setup_registration(self, fixed, moving):
         
         fixed_path = os.path.join(self.data_path, f'{fixed}_{self.um}um_{self.orientation}.tif' )
@@ -623,16 +810,22 @@ class VolumeRegistration:
             print(f'moving point path={moving_point_path}')
             print(f'fixed point path={fixed_point_path}')
         
-        fixedImage = sitk.ReadImage(fixed_path, sitk.sitkFloat32)
-        movingImage = sitk.ReadImage(moving_path, sitk.sitkFloat32)
+        # cached, so registering both ways reuses the images read for the first direction
+        fixedImage = self.read_volume(fixed_path, sitk.sitkFloat32)
+        movingImage = self.read_volume(moving_path, sitk.sitkFloat32)
         elastixImageFilter = sitk.ElastixImageFilter()
         elastixImageFilter.SetFixedImage(fixedImage)
         elastixImageFilter.SetMovingImage(movingImage)
+        elastixImageFilter.SetFixedMask(self.get_tissue_mask(fixedImage))
 
-        transParameterMap = sitk.GetDefaultParameterMap('translation')
         rigidParameterMap = sitk.GetDefaultParameterMap('rigid')
-        rigidParameterMap["NumberOfResolutions"] = ["6"] # Takes lots of RAM
+        # elastix centers the volumes on each other before the rigid stage, 
+        # this replaces a separate translation registration
+        rigidParameterMap["AutomaticTransformInitialization"] = ["true"]
+        rigidParameterMap["AutomaticTransformInitializationMethod"] = ["GeometricalCenter"]
+        rigidParameterMap["NumberOfResolutions"] = [self.number_of_resolutions] # Takes lots of RAM
         rigidParameterMap["MaximumNumberOfIterations"] = [self.rigidIterations] 
+        rigidParameterMap["WriteResultImage"] = ["false"]
 
         affineParameterMap = sitk.GetDefaultParameterMap('affine')
         affineParameterMap["UseDirectionCosines"] = ["true"]
@@ -643,17 +836,22 @@ class VolumeRegistration:
 
         bsplineParameterMap = sitk.GetDefaultParameterMap('bspline')
         bsplineParameterMap["MaximumNumberOfIterations"] = [self.bsplineIterations] # 250 works ok
+        # let ASGD estimate its step sizes from the displacement distribution and adapt
+        # them while running, so the bspline stage settles in fewer iterations
+        bsplineParameterMap["AutomaticParameterEstimation"] = ["true"]
+        bsplineParameterMap["ASGDParameterEstimationMethod"] = ["DisplacementDistribution"]
+        bsplineParameterMap["UseAdaptiveStepSizes"] = ["true"]
+        bsplineParameterMap["MaximumStepLength"] = ["1.0"]
         if not self.debug:
             bsplineParameterMap["WriteResultImage"] = ["false"]
             bsplineParameterMap["UseDirectionCosines"] = ["true"]
-            bsplineParameterMap["FinalGridSpacingInVoxels"] = [f"{self.um}"]
+            bsplineParameterMap["FinalGridSpacingInVoxels"] = self.get_grid_spacing_in_voxels(fixed)
             bsplineParameterMap["MaximumNumberOfSamplingAttempts"] = [self.number_of_sampling_attempts]
-            bsplineParameterMap["NumberOfResolutions"]= ["6"]
-            bsplineParameterMap["GridSpacingSchedule"] = ["6.219", "4.1", "2.8", "1.9", "1.4", "1.0"]
+            bsplineParameterMap["NumberOfResolutions"]= [self.number_of_resolutions]
+            bsplineParameterMap["GridSpacingSchedule"] = ["2.8", "1.9", "1.4", "1.0"]
             del bsplineParameterMap["FinalGridSpacingInPhysicalUnits"]
 
-        elastixImageFilter.SetParameterMap(transParameterMap)
-        elastixImageFilter.AddParameterMap(rigidParameterMap)
+        elastixImageFilter.SetParameterMap(rigidParameterMap)
         elastixImageFilter.AddParameterMap(affineParameterMap)
         if os.path.exists(fixed_point_path) and os.path.exists(moving_point_path):
             with open(fixed_point_path, 'r') as fp:
@@ -670,9 +868,13 @@ class VolumeRegistration:
             elastixImageFilter.SetFixedPointSetFileName(fixed_point_path)
             elastixImageFilter.SetMovingPointSetFileName(moving_point_path)
         elastixImageFilter.AddParameterMap(bsplineParameterMap)
-        elastixImageFilter.SetParameter("NumberOfSpatialSamples", "16000")
-        elastixImageFilter.SetParameter("UseRandomSampleRegion", "true")
-        elastixImageFilter.SetParameter("SampleRegionSize", "150")
+        elastixImageFilter.SetParameter("NumberOfSpatialSamples", self.number_of_spatial_samples)
+        # the coarse rigid levels are smoothed and small, fewer samples do there
+        resolutions = int(self.number_of_resolutions)
+        rigid_samples = ["2048"] * 2 + [self.number_of_spatial_samples] * (resolutions - 2)
+        elastixImageFilter.SetParameter(0, "NumberOfSpatialSamples", rigid_samples)
+        # draw the samples only from the tissue in the fixed mask
+        elastixImageFilter.SetParameter("ImageSampler", "RandomSparseMask")
         elastixImageFilter.SetParameter("ResultImageFormat", "tif")
         elastixImageFilter.SetLogToFile(True)
         elastixImageFilter.LogToConsoleOff()
@@ -684,7 +886,7 @@ class VolumeRegistration:
     
     def crop_volume(self):
 
-        moving_volume = io.imread(self.moving_volume_path)
+        moving_volume = memmap_volume(self.moving_volume_path)
         moving_volume = moving_volume[:,MOVING_CROP:500, MOVING_CROP:725]
         savepath = os.path.join(self.data_path, f'Atlas_{self.um}um_{self.orientation}.tif')
         print(f'Saving img to {savepath}')
@@ -728,7 +930,7 @@ class VolumeRegistration:
             if not os.path.exists(brainpath):
                 print(f'{brainpath} does not exist, exiting.')
                 sys.exit()
-            brainimg = read_image(brainpath)
+            brainimg = memmap_volume(brainpath)
             if brainimg.dtype == np.uint8:
                 brainimg = brainimg.astype(np.float32)
             volumes.append(brainimg)
@@ -813,7 +1015,7 @@ class VolumeRegistration:
         if os.path.exists(result_path):
             status.append(f'\tRegistered volume at {result_path}')
 
-        reverse_transformation_pfile = os.path.join(self.reverse_elastix_output, 'TransformParameters.3.txt')
+        reverse_transformation_pfile = os.path.join(self.reverse_elastix_output, LAST_TRANSFORM_FILE)
         if os.path.exists(reverse_transformation_pfile):
             status.append(f'\tTransformParameters file to register points at: {reverse_transformation_pfile}')
 
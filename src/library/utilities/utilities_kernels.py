@@ -0,0 +1,76 @@
+"""Small numeric kernels used in the registration and masking code.
+When numba is installed the loops are compiled and run in parallel over
+all cores, the compiled code is cached to disk so only the very first call
+pays for the compile. Without numba the same results come from numpy.
+"""
+import numpy as np
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(packed):
+    """Counts the set bits of a uint8 array made by np.packbits
+
+    :param packed: numpy uint8 array
+    :return: int
+    """
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(packed).sum(dtype=np.int64))
+    return int(POPCOUNT_TABLE[packed].sum(dtype=np.int64))
+
+
+if NUMBA_AVAILABLE:
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _dice_counts(a, b, table):
+        inter = 0
+        sa = 0
+        sb = 0
+        for i in prange(a.size):
+            inter += table[a[i] & b[i]]
+            sa += table[a[i]]
+            sb += table[b[i]]
+        return inter, sa, sb
+
+    @njit(parallel=True, cache=True)
+    def _apply_lut(arr, lut, out):
+        for i in prange(arr.size):
+            out[i] = lut[arr[i]]
+        return out
+
+
+def dice_counts(a, b):
+    """The bit counts needed for the Dice coefficient of two packed volumes,
+    done in one pass over the bytes.
+
+    :param a: uint8 array made by np.packbits
+    :param b: uint8 array made by np.packbits, same size as a
+    :return: tuple of the set bits in a & b, in a and in b
+    """
+    if NUMBA_AVAILABLE:
+        a = np.ascontiguousarray(a).ravel()
+        b = np.ascontiguousarray(b).ravel()
+        inter, sa, sb = _dice_counts(a, b, POPCOUNT_TABLE.astype(np.int64))
+        return int(inter), int(sa), int(sb)
+    return popcount(a & b), popcount(a), popcount(b)
+
+
+def apply_lut(arr, lut):
+    """Maps an integer image through a lookup table, same as lut[arr]
+
+    :param arr: numpy integer array, every value must be an index of lut
+    :param lut: 1D numpy array
+    :return: numpy array with the shape of arr and the dtype of lut
+    """
+    if NUMBA_AVAILABLE:
+        flat = np.ascontiguousarray(arr).ravel()
+        out = np.empty(flat.size, dtype=lut.dtype)
+        return _apply_lut(flat, lut, out).reshape(arr.shape)
+    return lut[arr]
@@ -6,7 +6,8 @@ import cv2
 import numpy as np
 from skimage.exposure import rescale_intensity
 
-from library.utilities.utilities_process import read_image, write_image
+from library.utilities.utilities_kernels import apply_lut
+from library.utilities.utilities_process import read_image, write_image, write_tiled_image
 
 
 def rotate_image(img, file: str, rotation: int):
@@ -49,7 +50,8 @@ def place_image(img, file: str, max_width, max_height, bgcolor=None):
         bottom_rows = img[start_bottom:img.shape[0], :]
         avg = np.mean(bottom_rows)
         bgcolor = int(round(avg))
-    new_img = np.zeros([max_height, max_width]).astype(dt) + bgcolor
+    # filled in the image dtype, no float64 buffer and no extra passes to cast and add
+    new_img = np.full([max_height, max_width], bgcolor, dtype=dt)
     #print(f'Resizing {file} from {img.shape} to {new_img.shape}')
     if img.ndim == 2:
         try:
@@ -60,14 +62,14 @@ def place_image(img, file: str, max_width, max_height, bgcolor=None):
             print(f'Could not place {file} with rows, columns:{img.shape[0]}x{img.shape[1]} in rows,columns={max_height}x{max_width}')
     if img.ndim == 3:
         try:
-            new_img = np.zeros([max_height, max_width, 3]) + bgcolor
+            new_img = np.full([max_height, max_width, 3], bgcolor, dtype=dt)
             new_img[startr:endr, startc:endc,0] = img[:,:,0]
             new_img[startr:endr, startc:endc,1] = img[:,:,1]
             new_img[startr:endr, startc:endc,2] = img[:,:,2]
         except:
             print(f'Could not place 3DIM {file} with width:{img.shape[1]}, height:{img.shape[0]} in {max_width}x{max_height}')
     del img
-    return new_img.astype(dt)
+    return new_img.astype(dt, copy=False)
 
 
 def normalize_image(img):
@@ -156,6 +158,19 @@ def normalize8(img):
     img = ((img - mn)/mx) * 2**8 - 1
     return np.round(img).astype(np.uint8) 
 
+def normalize8_lut(img):
+    """Same result as normalize8 for uint8 and uint16 images. These have at most
+    65536 values, so the scaling is done once per value and the image is
+    mapped through the table in one pass. Other dtypes use normalize8.
+    """
+    if img.dtype not in (np.uint8, np.uint16):
+        return normalize8(img)
+    mn = int(img.min())
+    mx = int(img.max())
+    lut = np.zeros(mx + 1, dtype=np.uint8)
+    lut[mn:] = normalize8(np.arange(mn, mx + 1, dtype=np.float64))
+    return apply_lut(img, lut)
+
 def normalize16(img):
     if img.dtype == np.uint32:
         print('image dtype is 32bit')
@@ -167,6 +182,24 @@ def normalize16(img):
         img = ((img - mn)/mx) * 2**16 - 1
         return np.round(img).astype(np.uint16) 
 
+CLEAN_SETTINGS = {}
+
+
+def set_clean_settings(rotation, flip, max_width, max_height, channel):
+    """Stores the settings shared by all sections for clean_and_rotate_image.
+    This is the initializer of each worker process.
+
+    :param rotation: number of 90 degree rotations
+    :param flip: either flip or flop
+    :param max_width: width of image
+    :param max_height: height of image
+    :param channel: channel we are working on
+    """
+
+    CLEAN_SETTINGS.update(rotation=rotation, flip=flip, max_width=max_width,
+                          max_height=max_height, channel=channel)
+
+
 def clean_and_rotate_image(file_key):
     """The main function that uses the user edited mask to crop out the tissue from 
     surrounding debris. It also rotates the image to
@@ -178,16 +211,18 @@ def clean_and_rotate_image(file_key):
     - infile file path of image to read
     - outpath file path of image to write
     - mask binary mask image of the image
-    - rotation number of 90 degree rotations
-    - flip either flip or flop
-    - max_width width of image
-    - max_height height of image
-    - scale used in scaling. Gotten from the histogram
+
+    The rotation, flip, max_width, max_height and channel come from set_clean_settings
 
     :return: nothing. we write the image to disk
     """
 
-    infile, outpath, maskfile, rotation, flip, max_width, max_height, channel = file_key
+    infile, outpath, maskfile = file_key
+    rotation = CLEAN_SETTINGS['rotation']
+    flip = CLEAN_SETTINGS['flip']
+    max_width = CLEAN_SETTINGS['max_width']
+    max_height = CLEAN_SETTINGS['max_height']
+    channel = CLEAN_SETTINGS['channel']
 
     img = read_image(infile)
     mask = read_image(maskfile)
@@ -210,7 +245,11 @@ def clean_and_rotate_image(file_key):
     cleaned = place_image(cleaned, infile, max_width, max_height, bgcolor=0)
 
     message = f'Error in saving {outpath} with shape {cleaned.shape} img type {cleaned.dtype}'
-    write_image(outpath, cleaned, message=message)
+    # thumbnails are only a few thousand pixels wide, full resolution images get tiled
+    if cleaned.ndim == 2 and max(cleaned.shape) > 10000:
+        write_tiled_image(outpath, cleaned, message=message)
+    else:
+        write_image(outpath, cleaned, message=message)
         
     return
 
@@ -251,31 +290,22 @@ def crop_image(img, mask):
 def get_image_box(mask):
     """Find new max width and height
 
-    :param img: numpy array of image
     :param mask: numpy array of mask
-    :return: numpy array of cropped image
+    :return: x1, y1, x2, y2 of the box around the mask
     """
 
     BUFFER = 2
-    mask = np.array(mask)
-    mask[mask > 0] = 255
-    _, thresh = cv2.threshold(mask, 200, 255, 0)
-    contours, _ = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    boxes = []
-    for contour in contours:
-        x, y, w, h = cv2.boundingRect(contour)
-        area = cv2.contourArea(contour)
-        if area > 100:
-            xmin = int(round(x))
-            ymin = int(round(y))
-            xmax = int(round(x + w))
-            ymax = int(round(y + h))
-            boxes.append([xmin, ymin, xmax, ymax])
-    x1 = min(x[0] for x in boxes) - BUFFER
-    y1 = min(x[1] for x in boxes) - BUFFER
-    x2 = max(x[2] for x in boxes) + BUFFER
-    y2 = max(x[3] for x in boxes) + BUFFER
-    x1, y1, x2, y2 = [0 if i < 0 else i for i in [x1, y1, x2, y2]]
+    thresh = np.asarray(mask) > 0
+    # Two reductions over the mask give the rows and columns that have any
+    # tissue, the first and last of them are the box. The masks have already
+    # been verified by the user, so small specks are no longer filtered out.
+    rows = thresh.any(axis=1)
+    cols = thresh.any(axis=0)
+    height, width = rows.shape[0], cols.shape[0]
+    y1 = max(int(rows.argmax()) - BUFFER, 0)
+    y2 = min(height - int(rows[::-1].argmax()) + BUFFER, height)
+    x1 = max(int(cols.argmax()) - BUFFER, 0)
+    x2 = min(width - int(cols[::-1].argmax()) + BUFFER, width)
     return x1, y1, x2, y2
 
 
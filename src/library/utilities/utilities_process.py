@@ -6,6 +6,7 @@ from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 import cv2
 import numpy as np
+import tifffile
 import gc
 from skimage.transform import rescale
 import math
@@ -203,6 +204,21 @@ def write_image(file_path, data, message: str = "Error") -> None:
         sys.exit()
 
 
+def write_tiled_image(file_path, data, message: str = "Error") -> None:
+    """Writes a large image as a tiled, lightly compressed TIFF. The tiles are
+    compressed in parallel by tifffile, so this is much quicker than a single
+    threaded strip write for full resolution images.
+    """
+
+    try:
+        tifffile.imwrite(file_path, data, bigtiff=True, photometric='minisblack', planarconfig='contig',
+                         tile=(512, 512), compression='zlib', compressionargs={'level': 1}, maxworkers=os.cpu_count())
+    except Exception as e:
+        print(message, e)
+        print("Unexpected error:", sys.exc_info()[0])
+        sys.exit()
+
+
 def read_image(file_path: str):
     """Reads an image from the filesystem with exceptions
     """
@@ -16,13 +16,19 @@ regarding one particular parameter.
  while the other parameters correspond to the translations that are measured in millimeters*
 
 """
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
 import numpy as np
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 import SimpleITK as sitk
+import tifffile
 
 from library.utilities.utilities_process import SCALING_FACTOR, read_image, write_image
 NUM_ITERATIONS = "1500"
+IMAGE_BUFFERS = threading.local()
+CV2_MAX_SIZE = 32767 # OpenCV's remap/warpAffine limit (SHRT_MAX) on either side
 
 
 def rigid_transform_to_parmeters(transform,center):
@@ -311,33 +317,180 @@ def convert_2d_transform_forms(arr):
     return np.vstack([arr, [0, 0, 1]])
 
 
+AFFINE_TRANSFORMS = {}
+
+
+def set_affine_transforms(transforms):
+    """Stores the (N, 3, 3) stack of transforms for align_indexed_image_to_affine.
+    This is the initializer of each worker process, so the transforms are
+    handed over once per worker (inherited on fork) instead of once per file.
+
+    :param transforms: numpy array of the stacked 3x3 transforms
+    """
+
+    AFFINE_TRANSFORMS['transforms'] = transforms
+
+
+def align_indexed_image_to_affine(file_key):
+    """Aligns one image with the transform at its index in the stack set by set_affine_transforms
+
+    :param file_key: tuple of index, file input and output
+    :return: nothing
+    """
+
+    index, infile, outfile = file_key
+    T = AFFINE_TRANSFORMS['transforms'][index]
+    align_image_to_affine((infile, outfile, T))
+
+
+def get_image_buffer(name, shape, dtype):
+    """Returns a reusable array for this thread. The images in a stack all have
+    the same size, so each worker allocates its buffers once instead of per image.
+
+    :param name: name of the buffer
+    :param shape: shape of the array
+    :param dtype: dtype of the array
+    :return: numpy array, the contents are not cleared
+    """
+
+    buffers = getattr(IMAGE_BUFFERS, 'buffers', None)
+    if buffers is None:
+        buffers = IMAGE_BUFFERS.buffers = {}
+    buf = buffers.get(name)
+    if buf is None or buf.shape != tuple(shape) or buf.dtype != np.dtype(dtype):
+        buf = np.empty(shape, dtype=dtype)
+        buffers[name] = buf
+    return buf
+
+
 def align_image_to_affine(file_key):
     """This is the method that takes the rigid transformation and uses
-    PIL to align the image.
-    This method takes about 20 seconds to run as compared to scikit's version 
-    which takes 220 seconds to run on a full scale image.
+    OpenCV's warpAffine to align the image. The transform from elastix already maps
+    the output pixels back onto the input, so it is handed to OpenCV as the inverse map
+    as is. OpenCV cannot warp images with a side of 32767 pixels or more, those
+    go through PIL which does the same nearest neighbour resampling.
+    The TIFFs are read with tifffile into a reused buffer and written with tifffile.
 
     :param file_key: tuple of file input and output
     :return: nothing
     """
     infile, outfile, T = file_key
     try:
-        im1 = Image.open(infile)
+        with tifffile.TiffFile(infile) as tif:
+            page = tif.pages[0]
+            img = get_image_buffer('input', page.shape, page.dtype)
+            page.asarray(out=img)
     except:
         print(f'align image to affine, could not open {infile}')
+        return
 
     try:
-        im2 = im1.transform((im1.size), Image.Transform.AFFINE, T.flatten()[:6], resample=Image.Resampling.NEAREST)
+        height, width = img.shape[:2]
+        if max(height, width) < CV2_MAX_SIZE:
+            M = np.ascontiguousarray(T[:2, :3], dtype=np.float64)
+            aligned = get_image_buffer('output', img.shape, img.dtype)
+            cv2.warpAffine(img, M, (width, height), dst=aligned,
+                           flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP,
+                           borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        else:
+            im1 = Image.fromarray(img)
+            im2 = im1.transform((im1.size), Image.Transform.AFFINE, T.flatten()[:6], resample=Image.Resampling.NEAREST)
+            aligned = np.asarray(im2)
+            del im1, im2
     except:
         print(f'align image to affine, could not transform {infile}')
+        return
+
+    write_aligned_image(outfile, aligned)
+    return
+
+
+def write_aligned_image(outfile, aligned):
+    """Writes an aligned section uncompressed with tifffile
+
+    :param outfile: path of the TIFF
+    :param aligned: numpy array of the aligned image
+    """
 
     try:
-        im2.save(outfile)
+        photometric = 'minisblack' if aligned.ndim == 2 else 'rgb'
+        tifffile.imwrite(outfile, aligned, photometric=photometric, compression=None)
     except:
-        print(f'align image to affine, could not save {infile}')
+        print(f'align image to affine, could not save {outfile}')
 
-    del im1, im2
-    return
+
+def read_tif_page(infile):
+    """Reads the first page of a TIFF with tifffile
+
+    :param infile: path of the TIFF
+    :return: numpy array
+    """
+
+    with tifffile.TiffFile(infile) as tif:
+        return tif.pages[0].asarray()
+
+
+def gpu_available():
+    """Checks if this OpenCV build has CUDA and can see a device
+
+    :return: boolean
+    """
+
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+
+def align_images_on_gpu(file_keys, transforms):
+    """Aligns the images with cv2.cuda.warpAffine in this process. One thread
+    reads the next TIFF and another writes the previous result while the GPU
+    warps the current one. Images the GPU fails on (e.g. out of device memory)
+    are aligned on the CPU with align_image_to_affine.
+
+    :param file_keys: list of tuples of index, file input and output
+    :param transforms: numpy array of the stacked 3x3 transforms
+    """
+
+    if len(file_keys) == 0:
+        return
+
+    stream = cv2.cuda_Stream()
+    gpu_src = cv2.cuda_GpuMat()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        pending_read = executor.submit(read_tif_page, file_keys[0][1])
+        pending_write = None
+        for n, (index, infile, outfile) in enumerate(file_keys):
+            T = transforms[index]
+            try:
+                img = pending_read.result()
+            except:
+                img = None
+                print(f'align image to affine, could not open {infile}')
+            if n + 1 < len(file_keys):
+                pending_read = executor.submit(read_tif_page, file_keys[n + 1][1])
+            if img is None:
+                continue
+
+            try:
+                height, width = img.shape[:2]
+                M = np.ascontiguousarray(T[:2, :3], dtype=np.float64)
+                gpu_src.upload(img, stream)
+                gpu_dst = cv2.cuda.warpAffine(gpu_src, M, (width, height),
+                                              flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP,
+                                              borderMode=cv2.BORDER_CONSTANT, borderValue=0, stream=stream)
+                aligned = gpu_dst.download(stream)
+                stream.waitForCompletion()
+            except cv2.error:
+                align_image_to_affine((infile, outfile, T))
+                continue
+
+            if pending_write is not None:
+                pending_write.result()
+            pending_write = executor.submit(write_aligned_image, outfile, aligned)
+
+        if pending_write is not None:
+            pending_write.result()
 
 
 def tif_to_png(file_key):
@@ -73,6 +73,10 @@ if __name__ == "__main__":
     parser.add_argument("--iterations", help="Enter iterations for alignment", required=False, default=2, type=int)
     parser.add_argument("--tg", help="Extend the mask to expose the entire underside of the brain", 
                         required=False, default=False)
+    parser.add_argument("--use_processes", help="Align images with processes instead of threads, enter true or false",
+                        required=False, default="false")
+    parser.add_argument("--gpu", help="Align images on the GPU when one is available, enter true or false",
+                        required=False, default="false")
     parser.add_argument("--task", 
                         help="Enter the task you want to perform: \
                         extract|mask|clean|histogram|align|create_metrics|extra_channel|neuroglancer|check_status",
@@ -87,10 +91,12 @@ if __name__ == "__main__":
     downsample = bool({"true": True, "false": False}[str(args.downsample).lower()])
     debug = bool({"true": True, "false": False}[str(args.debug).lower()])
     tg = bool({"true": True, "false": False}[str(args.tg).lower()])
+    use_processes = bool({"true": True, "false": False}[str(args.use_processes).lower()])
+    gpu = bool({"true": True, "false": False}[str(args.gpu).lower()])
     task = str(args.task).strip().lower()
 
     pipeline = Pipeline(animal, rescan_number=rescan_number, channel=channel, iterations=iterations, 
-                        downsample=downsample, tg=tg, task=task, debug=False)
+                        downsample=downsample, tg=tg, task=task, debug=False, use_processes=use_processes, gpu=gpu)
 
     function_mapping = {'extract': pipeline.extract,
                         'mask': pipeline.mask,
@@ -767,9 +767,13 @@ def collect_points_post_transformix(src, point_or_index = 'point'):
         fl.close()
         
     #####populate post-transformed array of contour centers
-    arr=np.empty((len(lines), 3))    
-    for i in range(len(lines)):        
-        arr[i,...]=lines[i].split()[lines[i].split().index(idx)+3:lines[i].split().index(idx)+6] #x,y,z
+    #the columns are the same on every line, so find the offset once and split each line once
+    arr=np.empty((len(lines), 3))
+    if len(lines) == 0:
+        return arr
+    offset = lines[0].split().index(idx)+3
+    for i, line in enumerate(lines):
+        arr[i,...]=line.split()[offset:offset+3] #x,y,z
         
     return arr
 
@@ -810,15 +814,9 @@ def transformed_pnts_to_allen(points_file, ch_type = 'injch', point_or_index=Non
     else:
         allen_id_table = pd.read_excel(allen_id_table_pth)
     ann=sitk.GetArrayFromImage(sitk.ReadImage(kwargs['annotationfile'])) ###zyx
-    with open(points_file, "rb") as f:                
-        lines=f.readlines()
-        f.close()
-
     #####populate post-transformed array of contour centers
-    sys.stdout.write('\n{} points detected\n\n'.format(len(lines)))
-    arr=np.empty((len(lines), 3))    
-    for i in range(len(lines)):        
-        arr[i,...]=lines[i].split()[lines[i].split().index(point_or_index)+3:lines[i].split().index(point_or_index)+6] #x,y,z
+    arr = collect_points_post_transformix(points_file, 'point' if point_or_index == 'OutputPoint' else 'index')
+    sys.stdout.write('\n{} points detected\n\n'.format(len(arr)))
         
     #optional save out of points
     np.save(kwargs['outputdirectory']+'/injection/zyx_voxels.npy', np.asarray([(z,y,x) for x,y,z in arr]))
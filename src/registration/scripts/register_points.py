@@ -1,37 +1,40 @@
 #!/usr/bin/env python3
 import sys
-from math import pi, sin, cos
+from math import pi
 
 import itk
+import numpy as np
+
+
+def point_set_from_array(points):
+    """Builds an itk.PointSet from an (N, dimension) array in one call
+    instead of one SetPoint call per point.
+    """
+    points = np.ascontiguousarray(points, dtype=np.float32)
+    point_set = itk.PointSet[itk.F, points.shape[1]].New()
+    point_set.Initialize()
+    try:
+        point_set.SetPoints(itk.vector_container_from_array(points.flatten()))
+    except TypeError:
+        # older ITK wrappings only take the points one by one
+        for count, point in enumerate(points):
+            point_set.SetPoint(count, point.tolist())
+    return point_set
 
 
 # Generate two circles with a small offset
 def make_circles(l_dimension: int = 2):
-    PointSetType = itk.PointSet[itk.F, l_dimension]
-
     RADIUS = 100
-    offset = [2.0] * l_dimension
-
-    fixed_points = PointSetType.New()
-    moving_points = PointSetType.New()
-    fixed_points.Initialize()
-    moving_points.Initialize()
+    offset = np.full(l_dimension, 2.0)
 
     step = 0.1
-    for count in range(0, int(2 * pi / step) + 1):
-
-        theta = count * step
-
-        fixed_point = list()
-        fixed_point.append(RADIUS * cos(theta))
-        for dim in range(1, l_dimension):
-            fixed_point.append(RADIUS * sin(theta))
-        fixed_points.SetPoint(count, fixed_point)
-
-        moving_point = [fixed_point[dim] + offset[dim] for dim in range(0, l_dimension)]
-        moving_points.SetPoint(count, moving_point)
+    theta = np.arange(0, int(2 * pi / step) + 1) * step
+    fixed_points = np.empty((len(theta), l_dimension))
+    fixed_points[:, 0] = RADIUS * np.cos(theta)
+    fixed_points[:, 1:] = (RADIUS * np.sin(theta))[:, None]
+    moving_points = fixed_points + offset
 
-    return fixed_points, moving_points
+    return point_set_from_array(fixed_points), point_set_from_array(moving_points)
 
 
 def test_registration(l_dimension: int = 2):
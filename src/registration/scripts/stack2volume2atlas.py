@@ -59,6 +59,7 @@ if __name__ == '__main__':
     function_mapping = {'create_volume': volumeRegistration.create_volume,
                         'register_volume': volumeRegistration.register_volume,
                         'reverse_register_volume': volumeRegistration.reverse_register_volume,
+                        'register_volume_both_ways': volumeRegistration.register_volume_both_ways,
                         'transformix_volume': volumeRegistration.transformix_volume,
                         'transformix_points': volumeRegistration.transformix_points,
                         'transformix_coms': volumeRegistration.transformix_coms,
@@ -0,0 +1,93 @@
+"""Checks that the faster versions of some image and point functions give the
+same results as the plain versions they replaced, on random inputs.
+Run it with pytest or directly with python.
+"""
+import sys
+import numpy as np
+import SimpleITK as sitk
+from pathlib import Path
+
+PIPELINE_ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(PIPELINE_ROOT.as_posix())
+
+from library.registration.registration_base import apply_transform_to_points
+from library.registration.volume_registration import dice
+from library.utilities import utilities_kernels
+from library.utilities.utilities_kernels import POPCOUNT_TABLE, apply_lut, dice_counts
+from library.utilities.utilities_mask import normalize8, normalize8_lut
+
+rng = np.random.default_rng(42)
+
+
+def test_normalize8_lut():
+    for dtype, high in ((np.uint8, 2**8), (np.uint16, 2**16)):
+        img = rng.integers(0, high, size=(64, 96), dtype=dtype)
+        assert np.array_equal(normalize8_lut(img), normalize8(img)), dtype
+        # a narrow range that does not start at 0
+        img = rng.integers(high // 4, high // 4 + 50, size=(64, 96), dtype=dtype)
+        assert np.array_equal(normalize8_lut(img), normalize8(img)), dtype
+
+
+def test_apply_transform_to_points():
+    points = rng.uniform(-500, 500, size=(1000, 3))
+    affine = sitk.AffineTransform(3)
+    affine.SetMatrix(rng.uniform(-2, 2, size=9).tolist())
+    affine.SetTranslation(rng.uniform(-50, 50, size=3).tolist())
+    affine.SetCenter(rng.uniform(-50, 50, size=3).tolist())
+    euler = sitk.Euler3DTransform(rng.uniform(-50, 50, size=3).tolist(),
+                                  *rng.uniform(-np.pi, np.pi, size=3).tolist(),
+                                  rng.uniform(-50, 50, size=3).tolist())
+    for transform in (affine, euler):
+        expected = np.array([transform.TransformPoint(point.tolist()) for point in points])
+        assert np.allclose(apply_transform_to_points(transform, points), expected, atol=1e-6), transform.GetName()
+
+
+def naive_dice(im1, im2):
+    im1 = np.asarray(im1).astype(bool)
+    im2 = np.asarray(im2).astype(bool)
+    return 2. * np.logical_and(im1, im2).sum() / (im1.sum() + im2.sum())
+
+
+def test_dice():
+    # a size that is not a multiple of 8, so the last packed byte is padded
+    shape = (37, 41, 29)
+    im1 = rng.random(shape) > 0.6
+    im2 = rng.random(shape) > 0.4
+    assert np.isclose(dice(im1, im2), naive_dice(im1, im2))
+    assert np.isclose(numpy_path(dice, im1, im2), naive_dice(im1, im2))
+    assert np.isclose(dice(im1, im1), 1.0)
+    labels1 = rng.integers(0, 3, size=shape, dtype=np.uint8)
+    labels2 = rng.integers(0, 3, size=shape).astype(np.float32)
+    assert np.isclose(dice(labels1, labels2), naive_dice(labels1, labels2))
+
+
+def numpy_path(function, *args):
+    """Calls function with the numba kernels switched off"""
+    numba_available = utilities_kernels.NUMBA_AVAILABLE
+    utilities_kernels.NUMBA_AVAILABLE = False
+    try:
+        return function(*args)
+    finally:
+        utilities_kernels.NUMBA_AVAILABLE = numba_available
+
+
+def test_dice_counts():
+    a = rng.integers(0, 256, size=10001, dtype=np.uint8)
+    b = rng.integers(0, 256, size=10001, dtype=np.uint8)
+    expected = tuple(int(POPCOUNT_TABLE[x].sum(dtype=np.int64)) for x in (a & b, a, b))
+    assert numpy_path(dice_counts, a, b) == expected
+    assert dice_counts(a, b) == expected
+
+
+def test_apply_lut():
+    lut = rng.integers(0, 256, size=2**16, dtype=np.uint8)
+    img = rng.integers(0, 2**16, size=(65, 97), dtype=np.uint16)
+    assert np.array_equal(numpy_path(apply_lut, img, lut), lut[img])
+    assert np.array_equal(apply_lut(img, lut), lut[img])
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith('test_') and callable(test):
+            test()
+            print(f'{name} ok')